@@ -14,7 +14,7 @@ class NSMarkovBuilder(Builder):
     name = 'ns_markov'
 
     def __init__(self, data_path: str, train_size: int, test_size: int,
-                 ssr: int, n_workers: int, batch_size: int):
+                 ssr: int, n_workers: int, batch_size: int, n_frames: int = 1):
         super().__init__()
         self.n_workers = n_workers
         self.batch_size = batch_size
@@ -29,7 +29,7 @@ class NSMarkovBuilder(Builder):
         B, X, Y, T = data.shape
 
         self.train_dataset = NavierStokesTrainingDataset(
-            data[:train_size])
+            data[:train_size], n_frames)
         self.test_dataset = NavierStokesDataset(
             data[-test_size:])
         # train_dataset.shape == [1000, 64, 64, 20]
@@ -63,19 +63,22 @@ class NSMarkovBuilder(Builder):
 
 
 class NavierStokesTrainingDataset(Dataset):
-    def __init__(self, data):
+    def __init__(self, data, n_frames=1):
         # data.shape == [B, X, Y, T]
-        x = data[..., 1:-1]
-        y = data[..., 2:]
+        # Each target holds the n_frames frames that follow its input.
+        T = data.shape[-1]
+        x = data[..., 1:T - n_frames]
+        y = data[..., 2:].unfold(-1, n_frames, 1)
 
-        dx = data[..., 1:-1] - data[..., :-2]
-        dy = data[..., 2:] - data[..., 1:-1]
+        diffs = data[..., 1:] - data[..., :-1]
+        dx = diffs[..., :T - n_frames - 1]
+        dy = diffs[..., 1:].unfold(-1, n_frames, 1)
 
         x = rearrange(x, 'b m n t -> (b t) m n 1')
-        y = rearrange(y, 'b m n t -> (b t) m n 1')
+        y = rearrange(y, 'b m n t k -> (b t) m n k')
 
         dx = rearrange(dx, 'b m n t -> (b t) m n 1')
-        dy = rearrange(dy, 'b m n t -> (b t) m n 1')
+        dy = rearrange(dy, 'b m n t k -> (b t) m n k')
 
         self.x = x
         self.y = y
@@ -1,2 +1,4 @@
-from .ns_2d import Force, get_random_force, solve_navier_stokes_2d
+from .ns_2d import (Force, SpectralRandomForce, get_random_force,
+                    solve_navier_stokes_2d)
 from .random_fields import GaussianRF
+from .writer import SnapshotWriter
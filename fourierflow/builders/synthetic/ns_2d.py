@@ -22,7 +22,7 @@ class Force(str, Enum):
 
 def solve_navier_stokes_2d(w0, visc, T, delta_t, record_steps, cycles=None,
                            scaling=None, t_scaling=None, force=Force.li,
-                           varying_force=False):
+                           varying_force=False, sink=None):
     """Solve Navier-Stokes equations in 2D using Crank-Nicolson method.
 
     Parameters
@@ -42,6 +42,12 @@ def solve_navier_stokes_2d(w0, visc, T, delta_t, record_steps, cycles=None,
     record_steps : int
         Number of in-time snapshots to record.
 
+    sink : callable, optional
+        If given, each snapshot is passed to sink(index, w, f) as soon as it
+        is recorded, where f is the time-varying force or None, instead of
+        being kept in memory. Both sol and the varying forces are then
+        returned as None.
+
     """
     seed = np.random.randint(1, 1000000000)
 
@@ -54,8 +60,9 @@ def solve_navier_stokes_2d(w0, visc, T, delta_t, record_steps, cycles=None,
     # Number of steps to final time
     steps = math.ceil(T / delta_t)
 
-    # Initial vorticity to Fourier space
-    w_h = torch.fft.fftn(w0, dim=[1, 2], norm='backward')
+    # Initial vorticity to Fourier space. The fields are real, so only the
+    # half of the spectrum with non-negative y-frequencies is kept.
+    w_h = torch.fft.rfft2(w0, dim=[1, 2], norm='backward')
 
     if force == Force.li:
         # Forcing function: 0.1*(sin(2pi(x+y)) + cos(2pi(x+y)))
@@ -79,30 +86,51 @@ def solve_navier_stokes_2d(w0, visc, T, delta_t, record_steps, cycles=None,
     if force == Force.none:
         f_h = 0
     elif not varying_force:
-        f_h = torch.fft.fftn(f, dim=[-2, -1], norm='backward')
+        f_h = torch.fft.rfft2(f, dim=[-2, -1], norm='backward')
 
         # If same forcing for the whole batch
         if len(f_h.shape) < len(w_h.shape):
             f_h = rearrange(f_h, '... -> 1 ...')
+    else:
+        # Time-varying forces are only ever updated in Fourier space.
+        random_force = SpectralRandomForce(
+            w0.shape[0], N, w0.device, cycles, scaling, t_scaling, seed)
 
     # Record solution every this number of steps
     record_time = math.floor(steps / record_steps)
 
-    # Wavenumbers in y-direction
-    k_y = torch.cat((
+    # Wavenumbers in y-direction, over the half spectrum
+    k_y = torch.arange(start=0, end=k_max + 1, step=1,
+                       device=w0.device).repeat(N, 1)
+    # Wavenumbers in x-direction
+    k_x = torch.cat((
         torch.arange(start=0, end=k_max, step=1, device=w0.device),
         torch.arange(start=-k_max, end=0, step=1, device=w0.device)),
-        0).repeat(N, 1)
-    # Wavenumbers in x-direction
-    k_x = k_y.transpose(0, 1)
+        0).repeat(k_max + 1, 1).transpose(0, 1)
+    # k_x.shape == k_y.shape == [N, N // 2 + 1]
 
     # Negative Laplacian in Fourier space
     lap = 4 * (math.pi**2) * (k_x**2 + k_y**2)
     lap[0, 0] = 1.0
 
+    # The full-spectrum solver takes the real part after each inverse
+    # transform, which cancels the derivatives at the Nyquist frequencies.
+    # Zeroing those wavenumbers gives the same result on the half spectrum.
+    d_y = k_y.clone()
+    d_y[:, k_max] = 0
+    d_x = k_x.clone()
+    d_x[k_max, :] = 0
+
+    # Spectral derivative operators. The first pair gives the velocity
+    # (psi_y, -psi_x) from the stream function, and the second gives the
+    # vorticity gradient (w_x, w_y).
+    psi_ops = 2j * math.pi * torch.stack([d_y, -d_x])
+    w_ops = 2j * math.pi * torch.stack([d_x, d_y])
+    # psi_ops.shape == w_ops.shape == [2, N, N // 2 + 1]
+
     if isinstance(visc, np.ndarray):
         visc = torch.from_numpy(visc).to(w0.device)
-        visc = repeat(visc, 'b -> b m n', m=N, n=N)
+        visc = repeat(visc, 'b -> b m n', m=N, n=k_max + 1)
         lap = repeat(lap, 'm n -> b m n', b=w0.shape[0])
 
     # Dealiasing mask
@@ -113,10 +141,11 @@ def solve_navier_stokes_2d(w0, visc, T, delta_t, record_steps, cycles=None,
         ).float(), 0)
 
     # Saving solution and time
-    sol = torch.zeros(*w0.size(), record_steps, device=w0.device)
     sol_t = torch.zeros(record_steps, device=w0.device)
-    if varying_force:
-        fs = torch.zeros(*w0.size(), record_steps, device=w0.device)
+    if sink is None:
+        sol = torch.zeros(*w0.size(), record_steps, device=w0.device)
+        if varying_force:
+            fs = torch.zeros(*w0.size(), record_steps, device=w0.device)
 
     # Record counter
     c = 0
@@ -127,37 +156,18 @@ def solve_navier_stokes_2d(w0, visc, T, delta_t, record_steps, cycles=None,
         # Stream function in Fourier space: solve Poisson equation
         psi_h = w_h / lap
 
-        # Velocity field in x-direction = psi_y
-        q = psi_h.clone()
-        q_real_temp = q.real.clone()
-        q.real = -2 * math.pi * k_y * q.imag
-        q.imag = 2 * math.pi * k_y * q_real_temp
-        q = torch.fft.ifftn(q, dim=[1, 2], norm='backward').real
-
-        # Velocity field in y-direction = -psi_x
-        v = psi_h.clone()
-        v_real_temp = v.real.clone()
-        v.real = 2 * math.pi * k_x * v.imag
-        v.imag = -2 * math.pi * k_x * v_real_temp
-        v = torch.fft.ifftn(v, dim=[1, 2], norm='backward').real
-
-        # Partial x of vorticity
-        w_x = w_h.clone()
-        w_x_temp = w_x.real.clone()
-        w_x.real = -2 * math.pi * k_x * w_x.imag
-        w_x.imag = 2 * math.pi * k_x * w_x_temp
-        w_x = torch.fft.ifftn(w_x, dim=[1, 2], norm='backward').real
-
-        # Partial y of vorticity
-        w_y = w_h.clone()
-        w_y_temp = w_y.real.clone()
-        w_y.real = -2 * math.pi * k_y * w_y.imag
-        w_y.imag = 2 * math.pi * k_y * w_y_temp
-        w_y = torch.fft.ifftn(w_y, dim=[1, 2], norm='backward').real
+        # Velocity field (psi_y, -psi_x) and the vorticity gradient, with
+        # all four fields brought back to physical space in one transform.
+        grads_h = torch.cat([psi_ops * psi_h[:, None], w_ops * w_h[:, None]],
+                            dim=1)
+        # grads_h.shape == [batch_size, 4, N, N // 2 + 1]
+        grads = torch.fft.irfft2(grads_h, s=(N, N), dim=[2, 3],
+                                 norm='backward')
+        q, v, w_x, w_y = grads.unbind(dim=1)
 
         # Non-linear term (u.grad(w)): compute in physical space then back to Fourier space
-        F_h = torch.fft.fftn(q * w_x + v * w_y,
-                             dim=[1, 2], norm='backward')
+        F_h = torch.fft.rfft2(q * w_x + v * w_y,
+                              dim=[1, 2], norm='backward')
 
         # Dealias
         F_h *= dealias
@@ -165,9 +175,8 @@ def solve_navier_stokes_2d(w0, visc, T, delta_t, record_steps, cycles=None,
         if force == Force.none:
             f_h = 0
         elif varying_force:
-            f = get_random_force(w0.shape[0], N, w0.device, cycles,
-                                 scaling, t, t_scaling, seed)
-            f_h = torch.fft.fftn(f, dim=[-2, -1], norm='backward')
+            f_t = t
+            f_h = random_force.spectrum(t)
 
         # Cranck-Nicholson update
         factor = 0.5 * delta_t * visc * lap
@@ -179,25 +188,36 @@ def solve_navier_stokes_2d(w0, visc, T, delta_t, record_steps, cycles=None,
 
         if (j + 1) % record_time == 0:
             # Solution in physical space
-            w = torch.fft.ifftn(w_h, dim=[1, 2], norm='backward').real
+            w = torch.fft.irfft2(w_h, s=(N, N), dim=[1, 2], norm='backward')
             if w.isnan().any().item():
                 raise ValueError('NaN values found.')
 
+            # The force applied in this step, in physical space.
+            f_c = random_force.field(f_t) if varying_force else None
+
             # Record solution and time
-            sol[..., c] = w
-            if varying_force:
-                fs[..., c] = f
+            if sink is not None:
+                sink(c, w, f_c)
+            else:
+                sol[..., c] = w
+                if varying_force:
+                    fs[..., c] = f_c
             sol_t[c] = t
 
             c += 1
 
+    if sink is not None:
+        sol, fs = None, None
+    else:
+        sol = sol.cpu().numpy()
+
     if varying_force:
         f = fs
 
-    if force != Force.none:
+    if force != Force.none and f is not None:
         f = f.cpu().numpy()
 
-    return sol.cpu().numpy(), f
+    return sol, f
 
 
 def get_random_force(b, s, device, cycles, scaling, t, t_scaling, seed):
@@ -235,3 +255,54 @@ def get_random_force(b, s, device, cycles, scaling, t, t_scaling, seed):
     f = f * scaling
 
     return f
+
+
+class SpectralRandomForce:
+    """The force of get_random_force, built directly in Fourier space.
+
+    Every term of the force is a single Fourier mode whose phase moves with
+    t_scaling * t, so its rfft2 is A e^{i t_scaling t} + B e^{-i t_scaling t}
+    for two sparse spectra A and B. The alphas are drawn once, in the same
+    order and from the same seed as get_random_force, so both give the same
+    force up to round-off.
+    """
+
+    def __init__(self, b, s, device, cycles, scaling, t_scaling, seed):
+        if cycles >= s // 2:
+            raise ValueError(f'Cannot fit {cycles} cycles on a grid of '
+                             f'width {s} below the Nyquist frequency')
+        self.s = s
+        self.t_scaling = t_scaling
+
+        gen = torch.Generator(device)
+        gen.manual_seed(seed)
+
+        # With norm='backward', a plane wave e^{i k.x} with amplitude c has
+        # the coefficient c * s^2 at frequency k.
+        A = torch.zeros(b, s, s // 2 + 1, dtype=torch.cfloat, device=device)
+        B = torch.zeros(b, s, s // 2 + 1, dtype=torch.cfloat, device=device)
+        for p in range(1, cycles + 1):
+            alphas = [torch.rand(b, generator=gen, device=device)
+                      for _ in range(6)]
+            # a sin(u + phi) + b cos(u + phi) == Re[(b - ia) e^{iu} e^{iphi}]
+            c_x, c_y, c_xy = [(alphas[i + 1] - 1j * alphas[i]) * s**2 / 2
+                              for i in [0, 2, 4]]
+
+            # The conjugate modes with negative y-frequencies are implied by
+            # the half spectrum, except along the x-axis where y is zero.
+            A[:, p, 0] += c_x
+            B[:, -p, 0] += c_x.conj()
+            A[:, 0, p] += c_y
+            A[:, p, p] += c_xy
+
+        self.A = A * scaling
+        self.B = B * scaling
+
+    def spectrum(self, t):
+        phase = complex(math.cos(self.t_scaling * t),
+                        math.sin(self.t_scaling * t))
+        return self.A * phase + self.B * phase.conjugate()
+
+    def field(self, t):
+        return torch.fft.irfft2(self.spectrum(t), s=(self.s, self.s),
+                                dim=[-2, -1], norm='backward')
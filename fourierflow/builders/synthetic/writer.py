@@ -0,0 +1,61 @@
+import queue
+import threading
+
+
+class SnapshotWriter:
+    """Write solver snapshots to HDF5 datasets from a background thread.
+
+    Pass put to solve_navier_stokes_2d as its sink, with the offset of the
+    batch bound, e.g. partial(writer.put, offset). Each snapshot is queued
+    as soon as it is recorded, and the thread copies it to the host and
+    writes it to u[offset:offset + batch_size, ..., index]. The queue is
+    bounded, so the solver waits rather than letting snapshots pile up
+    when the disk can't keep up.
+
+    Use the writer as a context manager. Leaving the context waits for all
+    queued snapshots to be written, and errors raised while writing are
+    raised again in the solver thread.
+    """
+
+    def __init__(self, u, f=None, max_queue=8):
+        self.u = u
+        self.f = f
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.queue.put(None)
+        self.thread.join()
+        self._check()
+
+    def put(self, offset, index, w, f=None):
+        self._check()
+        self.queue.put((offset, index, w, f))
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is not None:
+                # Keep draining so that the solver is never blocked.
+                continue
+
+            offset, index, w, f = item
+            try:
+                w = w.cpu().numpy()
+                self.u[offset:offset + len(w), ..., index] = w
+                if f is not None and self.f is not None:
+                    f = f.cpu().numpy()
+                    self.f[offset:offset + len(f), ..., index] = f
+            except Exception as e:
+                self.error = e
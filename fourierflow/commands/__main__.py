@@ -1,11 +1,13 @@
 from typer import Typer
 
-from fourierflow.commands import download, generate, plot, predict, test, train
+from fourierflow.commands import (benchmark, download, generate, plot, predict,
+                                  test, train)
 from fourierflow.utils import setup_logger
 
 setup_logger()
 
 app = Typer()
+app.add_typer(benchmark.app, name='benchmark')
 app.add_typer(download.app, name='download')
 app.add_typer(generate.app, name='generate')
 app.add_typer(plot.app, name='plot')
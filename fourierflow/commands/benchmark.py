@@ -0,0 +1,965 @@
+import math
+import time
+from copy import deepcopy
+from functools import partial
+from pathlib import Path
+from typing import List, Optional
+
+import hydra
+import numpy as np
+import scipy.io
+import torch
+from einops import rearrange
+from hydra.utils import instantiate
+from omegaconf import OmegaConf
+from torch.profiler import ProfilerActivity, profile
+from typer import Option, Typer
+
+from fourierflow.builders.synthetic import (Force, GaussianRF,
+                                            SpectralRandomForce,
+                                            get_random_force,
+                                            solve_navier_stokes_2d)
+from fourierflow.modules import FNOFactorized2DBlock
+from fourierflow.modules.fno_factorized_2d import SpectralConv2d
+from fourierflow.modules.fno_factorized_3d import SpectralConv3d
+from fourierflow.modules.spectral import (BACKENDS, FactorizedSpectralWeight,
+                                          contract_groups, contract_modes)
+from fourierflow.routines import Grid2DMarkovExperiment
+from fourierflow.utils import compile_fn
+
+app = Typer()
+
+
+def time_fn(fn, n_repeats, n_warmup=3):
+    """Return the average wall time in seconds of a single call to fn."""
+    with torch.no_grad():
+        for _ in range(n_warmup):
+            fn()
+        start = time.perf_counter()
+        for _ in range(n_repeats):
+            fn()
+        elapsed = time.perf_counter() - start
+    return elapsed / n_repeats
+
+
+def allocated_bytes(fn):
+    """Return the total bytes allocated on the CPU during a call to fn."""
+    with torch.no_grad():
+        with profile(activities=[ProfilerActivity.CPU],
+                     profile_memory=True) as prof:
+            fn()
+    return sum(e.self_cpu_memory_usage for e in prof.key_averages()
+               if e.self_cpu_memory_usage > 0)
+
+
+def saved_activation_bytes(fn):
+    """Return the bytes of tensors saved for backward while running fn."""
+    saved = {}
+
+    def pack(tensor):
+        saved[tensor.data_ptr()] = tensor.numel() * tensor.element_size()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        fn()
+    return sum(saved.values())
+
+
+def build_spectral_conv(width, modes, **kwargs):
+    layer_kwargs = dict(in_dim=width, out_dim=width, n_modes=modes,
+                        forecast_ff=None, backcast_ff=None,
+                        fourier_weight=None, factor=4, norm_locs=[],
+                        group_width=None, ff_weight_norm=False, n_ff_layers=2,
+                        layer_norm=False, use_fork=False, dropout=0.0,
+                        mode='full')
+    layer_kwargs.update(kwargs)
+    return SpectralConv2d(**layer_kwargs).eval()
+
+
+def build_block(**kwargs):
+    # Mirrors the conv in experiments/ns_zongyi_4/markov/24_layers.
+    block_kwargs = dict(modes=16, width=64, input_dim=3, n_layers=24,
+                        share_weight=True, factor=4, ff_weight_norm=True,
+                        next_input='add', gain=0.1, avg_outs=True)
+    block_kwargs.update(kwargs)
+    return FNOFactorized2DBlock(**block_kwargs).eval()
+
+
+def build_routine(n_steps=10, **kwargs):
+    conv = build_block(**kwargs)
+    routine = Grid2DMarkovExperiment(conv=conv, n_steps=n_steps,
+                                     n_frames=conv.n_frames, optimizer=None,
+                                     scheduler=None)
+    # Give the normalizer some non-trivial statistics.
+    routine.normalizer(torch.randn(1000, routine.conv.input_dim) * 2 + 1)
+    return routine.eval()
+
+
+def load_experiment(config_dir, trial=0):
+    """Load the trained routine of an experiment and build its dataset."""
+    hydra.initialize(config_path=Path('../..') / config_dir)
+    config = hydra.compose(config_name='config')
+    OmegaConf.set_struct(config, False)
+    config.builder.n_workers = 0
+
+    chkpt_dir = Path(config_dir) / 'checkpoints'
+    paths = list(chkpt_dir.glob(f'trial-{trial}-*/epoch*.ckpt'))
+    assert len(paths) == 1
+
+    builder = instantiate(config.builder)
+    routine = instantiate(config.routine)
+    routine.load_lightning_model_state(str(paths[0]), 'cpu')
+    return routine.eval(), builder
+
+
+def rollout_loss(routine, loader):
+    """Return the mean rollout loss of the routine over a data loader."""
+    losses = []
+    with torch.no_grad():
+        for batch in loader:
+            losses.append(routine._valid_step(batch)[1].item())
+    return sum(losses) / len(losses)
+
+
+def dense_forward_fourier(layer, x):
+    # The original implementation, which zero-fills a full-sized output
+    # spectrum for each axis. Kept here as the reference for benchmarks.
+    x = rearrange(x, 'b m n i -> b i m n')
+    B, I, M, N = x.shape
+
+    x_fty = torch.fft.rfft(x, dim=-1, norm='ortho')
+    out_ft = x_fty.new_zeros(B, I, M, N // 2 + 1)
+    out_ft[:, :, :, :layer.n_modes] = torch.einsum(
+        "bixy,ioy->boxy",
+        x_fty[:, :, :, :layer.n_modes],
+        torch.view_as_complex(layer.fourier_weight[0]))
+    xy = torch.fft.irfft(out_ft, n=N, dim=-1, norm='ortho')
+
+    x_ftx = torch.fft.rfft(x, dim=-2, norm='ortho')
+    out_ft = x_ftx.new_zeros(B, I, M // 2 + 1, N)
+    out_ft[:, :, :layer.n_modes, :] = torch.einsum(
+        "bixy,iox->boxy",
+        x_ftx[:, :, :layer.n_modes, :],
+        torch.view_as_complex(layer.fourier_weight[1]))
+    xx = torch.fft.irfft(out_ft, n=M, dim=-2, norm='ortho')
+
+    return rearrange(xx + xy, 'b i m n -> b m n i')
+
+
+def real_complex_matmul_2d(a, b):
+    # The original contraction in FNOZongyi2DBlock, which works on real
+    # tensors with a trailing (real, imag) dimension.
+    op = partial(torch.einsum, "bixy,ioxy->boxy")
+    return torch.stack([
+        op(a[..., 0], b[..., 0]) - op(a[..., 1], b[..., 1]),
+        op(a[..., 1], b[..., 0]) + op(a[..., 0], b[..., 1])
+    ], dim=-1)
+
+
+def dense_spectral_conv_3d(x, weights, modes):
+    # A full 3D FNO layer as in Li et al (2021), with n_modes^3 weights for
+    # each of the four corners of the spectrum that it keeps.
+    # x.shape == [batch_size, in_dim, grid_size, grid_size, grid_size]
+    B, I, X, Y, Z = x.shape
+    x_ft = torch.fft.rfftn(x, dim=[-3, -2, -1], norm='ortho')
+    out_ft = x_ft.new_zeros(B, weights.shape[2], X, Y, Z // 2 + 1)
+    m = modes
+    corners = [(slice(None, m), slice(None, m)),
+               (slice(-m, None), slice(None, m)),
+               (slice(None, m), slice(-m, None)),
+               (slice(-m, None), slice(-m, None))]
+    for weight, (sx, sy) in zip(weights, corners):
+        out_ft[:, :, sx, sy, :m] = torch.einsum(
+            'bixyz,ioxyz->boxyz', x_ft[:, :, sx, sy, :m], weight)
+    return torch.fft.irfftn(out_ft, s=(X, Y, Z), dim=[-3, -2, -1],
+                            norm='ortho')
+
+
+def fftn_navier_stokes_2d(w0, visc, T, delta_t, record_steps):
+    # The original full-spectrum solver with the forcing of Li et al (2021).
+    # Kept here as the reference for benchmarks.
+    N = w0.shape[-1]
+    k_max = N // 2
+    steps = math.ceil(T / delta_t)
+    record_time = math.floor(steps / record_steps)
+
+    ft = torch.linspace(0, 1, N + 1, device=w0.device)[:-1]
+    X, Y = torch.meshgrid(ft, ft, indexing='ij')
+    f = 0.1 * (torch.sin(2 * math.pi * (X + Y)) +
+               torch.cos(2 * math.pi * (X + Y)))
+    f_h = torch.fft.fftn(f, dim=[-2, -1], norm='backward')[None]
+
+    k_y = torch.cat((torch.arange(0, k_max, device=w0.device),
+                     torch.arange(-k_max, 0, device=w0.device))).repeat(N, 1)
+    k_x = k_y.transpose(0, 1)
+    lap = 4 * (math.pi**2) * (k_x**2 + k_y**2)
+    lap[0, 0] = 1.0
+    dealias = torch.logical_and(torch.abs(k_y) <= (2.0 / 3.0) * k_max,
+                                torch.abs(k_x) <= (2.0 / 3.0) * k_max)[None]
+
+    def ifft(x_h):
+        return torch.fft.ifftn(x_h, dim=[1, 2], norm='backward').real
+
+    w_h = torch.fft.fftn(w0, dim=[1, 2], norm='backward')
+    sol = torch.zeros(*w0.shape, record_steps, device=w0.device)
+    for j in range(steps):
+        psi_h = w_h / lap
+        q = ifft(2j * math.pi * k_y * psi_h)
+        v = ifft(-2j * math.pi * k_x * psi_h)
+        w_x = ifft(2j * math.pi * k_x * w_h)
+        w_y = ifft(2j * math.pi * k_y * w_h)
+        F_h = torch.fft.fftn(q * w_x + v * w_y, dim=[1, 2], norm='backward')
+        F_h *= dealias
+
+        factor = 0.5 * delta_t * visc * lap
+        num = -delta_t * F_h + delta_t * f_h + (1.0 - factor) * w_h
+        w_h = num / (1.0 + factor)
+
+        if (j + 1) % record_time == 0:
+            sol[..., (j + 1) // record_time - 1] = ifft(w_h)
+
+    return sol.cpu().numpy()
+
+
+@app.command()
+def spectral_conv(
+    grid_sizes: List[int] = Option([64, 128, 256], help='Grid sizes to test'),
+    batch_size: int = Option(20, help='Batch size'),
+    width: int = Option(64, help='Number of hidden channels'),
+    modes: int = Option(16, help='Number of Fourier modes'),
+    n_repeats: int = Option(20, help='Number of timed calls'),
+    seed: int = Option(38124, help='Seed value for reproducibility'),
+):
+    """Compare the truncated spectral path against the zero-filled one."""
+    torch.manual_seed(seed)
+    layer = build_spectral_conv(width, modes)
+
+    for s in grid_sizes:
+        x = torch.randn(batch_size, s, s, width)
+        with torch.no_grad():
+            error = (layer.forward_fourier(x) -
+                     dense_forward_fourier(layer, x)).abs().max().item()
+
+        for name, fn in [('dense', lambda: dense_forward_fourier(layer, x)),
+                         ('truncated', lambda: layer.forward_fourier(x))]:
+            elapsed = time_fn(fn, n_repeats)
+            n_bytes = allocated_bytes(fn)
+            print(f'grid {s:4d} | {name:9s} | {elapsed * 1000:8.2f} ms | '
+                  f'{n_bytes / 2**20:8.1f} MB allocated')
+        print(f'grid {s:4d} | max abs difference: {error:.2e}')
+
+
+@app.command()
+def fused_axes(
+    grid_sizes: List[int] = Option([32, 64, 128, 256],
+                                   help='Grid sizes to test'),
+    batch_size: int = Option(20, help='Batch size'),
+    width: int = Option(64, help='Number of hidden channels'),
+    modes: int = Option(16, help='Number of Fourier modes'),
+    n_repeats: int = Option(20, help='Number of timed calls'),
+    seed: int = Option(38124, help='Seed value for reproducibility'),
+):
+    """Compare separate and fused mixing of the two Fourier axes."""
+    torch.manual_seed(seed)
+    layer = build_spectral_conv(width, modes)
+
+    for s in grid_sizes:
+        x = torch.randn(batch_size, width, s, s)
+        with torch.no_grad():
+            error = (layer.mix_axes(x) -
+                     layer.mix_axes_fused(x)).abs().max().item()
+
+        for name, fn in [('separate', lambda: layer.mix_axes(x)),
+                         ('fused', lambda: layer.mix_axes_fused(x))]:
+            elapsed = time_fn(fn, n_repeats)
+            print(f'grid {s:4d} | {name:8s} | {elapsed * 1000:8.2f} ms')
+        print(f'grid {s:4d} | max abs difference: {error:.2e}')
+
+
+@app.command()
+def contraction(
+    grid_sizes: List[int] = Option([64, 128, 256], help='Grid sizes to test'),
+    batch_size: int = Option(20, help='Batch size'),
+    width: int = Option(64, help='Number of hidden channels'),
+    modes: int = Option(16, help='Number of Fourier modes'),
+    n_repeats: int = Option(20, help='Number of timed calls'),
+    seed: int = Option(38124, help='Seed value for reproducibility'),
+):
+    """Compare the spectral contraction backends used by the FNO blocks."""
+    torch.manual_seed(seed)
+    w_1d = torch.randn(width, width, modes, dtype=torch.cfloat)
+    w_2d = torch.randn(width, width, modes, modes, dtype=torch.cfloat)
+
+    for s in grid_sizes:
+        # The factorized block contracts one axis of the truncated spectrum,
+        # while the plus and zongyi blocks contract both.
+        x_1d = torch.randn(batch_size, width, s, modes, dtype=torch.cfloat)
+        x_2d = torch.randn(batch_size, width, modes, modes, dtype=torch.cfloat)
+
+        cases = {
+            'factorized': (x_1d, w_1d, (3,)),
+            'plus/zongyi': (x_2d, w_2d, (2, 3)),
+        }
+        for case, (x, w, dims) in cases.items():
+            ref = contract_modes(x, w, dims, backend='einsum')
+            for backend in BACKENDS:
+                fn = partial(contract_modes, x, w, dims, backend=backend)
+                with torch.no_grad():
+                    error = (fn() - ref).abs().max().item()
+                elapsed = time_fn(fn, n_repeats)
+                print(f'grid {s:4d} | {case:11s} | {backend:6s} | '
+                      f'{elapsed * 1000:8.2f} ms | max abs diff {error:.2e}')
+
+        # The real-valued path that zongyi used before sharing the contraction.
+        x_real = torch.view_as_real(x_2d)
+        w_real = torch.view_as_real(w_2d)
+        with torch.no_grad():
+            out = torch.view_as_complex(real_complex_matmul_2d(x_real, w_real))
+            error = (out - contract_modes(x_2d, w_2d, (2, 3))).abs().max().item()
+        elapsed = time_fn(lambda: real_complex_matmul_2d(x_real, w_real),
+                          n_repeats)
+        print(f'grid {s:4d} | {"zongyi":11s} | {"real":6s} | '
+              f'{elapsed * 1000:8.2f} ms | max abs diff {error:.2e}')
+
+
+@app.command()
+def layout(
+    grid_sizes: List[int] = Option([64, 128], help='Grid sizes to test'),
+    batch_size: int = Option(20, help='Batch size'),
+    n_layers: int = Option(24, help='Number of spectral layers'),
+    n_repeats: int = Option(10, help='Number of timed calls'),
+    seed: int = Option(38124, help='Seed value for reproducibility'),
+):
+    """Compare channels-last and channels-first execution of the F-FNO."""
+    torch.manual_seed(seed)
+    last = build_block(n_layers=n_layers)
+    first = build_block(n_layers=n_layers, channels_first=True)
+    first.load_state_dict(last.state_dict())
+
+    for s in grid_sizes:
+        x = torch.randn(batch_size, s, s, last.input_dim)
+        with torch.no_grad():
+            error = (last(x)['forecast'] -
+                     first(x)['forecast']).abs().max().item()
+
+        for name, block in [('channels-last', last), ('channels-first', first)]:
+            elapsed = time_fn(lambda: block(x), n_repeats)
+            print(f'grid {s:4d} | {name:14s} | {elapsed * 1000:8.2f} ms')
+        print(f'grid {s:4d} | max abs difference: {error:.2e}')
+
+
+@app.command()
+def precision(
+    grid_sizes: List[int] = Option([64], help='Grid sizes to test'),
+    batch_size: int = Option(20, help='Batch size'),
+    n_repeats: int = Option(10, help='Number of timed calls'),
+    config_dir: Optional[str] = Option(
+        None, help='Experiment whose trained routine and test split to use'),
+    trial: int = Option(0, help='Trial of the experiment'),
+    seed: int = Option(38124, help='Seed value for reproducibility'),
+):
+    """Compare the fp32 and bf16 precision policies on the 24-layer F-FNO.
+
+    Without an experiment, a random block is run on random inputs. With one,
+    e.g. experiments/ns_zongyi_4/markov/24_layers, the trained routine is
+    rolled out on the test split and the test loss of each policy is shown.
+    """
+    torch.manual_seed(seed)
+    if config_dir:
+        routine, builder = load_experiment(config_dir, trial)
+        for policy in ['fp32', 'bf16']:
+            routine.precision_policy = policy
+            start = time.perf_counter()
+            loss = rollout_loss(routine, builder.test_dataloader())
+            elapsed = time.perf_counter() - start
+            print(f'{policy:4s} | {elapsed:8.2f} s | test loss {loss:.5f}')
+        return
+
+    block = build_block()
+
+    for s in grid_sizes:
+        x = torch.randn(batch_size, s, s, block.input_dim)
+        with torch.no_grad():
+            ref = block(x)['forecast']
+            with torch.autocast('cpu', dtype=torch.bfloat16):
+                out = block(x)['forecast'].float()
+        drift = ((out - ref).norm() / ref.norm()).item()
+
+        def run_bf16():
+            with torch.autocast('cpu', dtype=torch.bfloat16):
+                return block(x)
+
+        for name, fn in [('fp32', lambda: block(x)), ('bf16', run_bf16)]:
+            elapsed = time_fn(fn, n_repeats)
+            print(f'grid {s:4d} | {name:4s} | {elapsed * 1000:8.2f} ms | '
+                  f'{batch_size / elapsed:8.1f} samples/s')
+        print(f'grid {s:4d} | relative drift of bf16 forecast: {drift:.2e}')
+
+
+@app.command()
+def checkpointing(
+    segment_sizes: List[int] = Option([0, 1, 2, 4, 6, 12],
+                                      help='Layers per checkpointed segment'),
+    grid_size: int = Option(64, help='Width of the grid'),
+    batch_size: int = Option(19, help='Batch size'),
+    n_repeats: int = Option(3, help='Number of timed calls'),
+    use_fork: bool = Option(False, help='Use the forecast fork'),
+    seed: int = Option(38124, help='Seed value for reproducibility'),
+):
+    """Compare activation memory and training throughput of checkpointing."""
+    torch.manual_seed(seed)
+    x = torch.randn(batch_size, grid_size, grid_size, 3)
+    state = build_block(use_fork=use_fork).state_dict()
+
+    for size in segment_sizes:
+        block = build_block(use_fork=use_fork, checkpoint_segment_size=size)
+        block.load_state_dict(state)
+        block.train()
+
+        def step():
+            block.zero_grad()
+            block(x)['forecast'].sum().backward()
+
+        n_bytes = saved_activation_bytes(lambda: block(x))
+        step()
+        start = time.perf_counter()
+        for _ in range(n_repeats):
+            step()
+        elapsed = (time.perf_counter() - start) / n_repeats
+        print(f'segment size {size:2d} | {n_bytes / 2**20:8.1f} MB saved | '
+              f'{elapsed * 1000:8.1f} ms per step | '
+              f'{batch_size / elapsed:6.1f} samples/s')
+
+
+@app.command()
+def compiled(
+    grid_size: int = Option(64, help='Width of the grid'),
+    batch_size: int = Option(1, help='Batch size'),
+    n_repeats: int = Option(50, help='Number of timed calls'),
+    seed: int = Option(38124, help='Seed value for reproducibility'),
+):
+    """Compare per-step latency of the eager and compiled F-FNO."""
+    torch.manual_seed(seed)
+    block = build_block(share_fork=True)
+    block_fn = compile_fn(block)
+    x = torch.randn(batch_size, grid_size, grid_size, block.input_dim)
+
+    with torch.no_grad():
+        error = (block(x)['forecast'] -
+                 block_fn(x)['forecast']).abs().max().item()
+
+    for name, fn in [('eager', block), ('compiled', block_fn)]:
+        elapsed = time_fn(lambda: fn(x), n_repeats)
+        print(f'{name:8s} | {elapsed * 1000:8.2f} ms per step')
+    print(f'max abs difference: {error:.2e}')
+
+
+@app.command()
+def freeze(
+    grid_size: int = Option(64, help='Width of the grid'),
+    batch_size: int = Option(1, help='Batch size'),
+    n_steps: int = Option(10, help='Number of rollout steps'),
+    n_repeats: int = Option(10, help='Number of timed rollouts'),
+    seed: int = Option(38124, help='Seed value for reproducibility'),
+):
+    """Compare rollout latency before and after freezing for inference."""
+    torch.manual_seed(seed)
+    routine = build_routine(n_steps)
+    frozen = deepcopy(routine).freeze_for_inference()
+    data = torch.randn(batch_size, grid_size, grid_size, n_steps + 1)
+
+    with torch.no_grad():
+        error = (routine(data)[2] - frozen(data)[2]).abs().max().item()
+
+    for name, model in [('original', routine), ('frozen', frozen)]:
+        elapsed = time_fn(lambda: model(data), n_repeats)
+        print(f'{name:8s} | {elapsed / n_steps * 1000:8.2f} ms per step')
+    print(f'max abs difference: {error:.2e}')
+
+
+@app.command()
+def low_rank(
+    ranks: List[int] = Option([4, 8, 16, 32], help='Ranks to test'),
+    widths: List[int] = Option([64, 128], help='Numbers of hidden channels'),
+    grid_size: int = Option(64, help='Width of the grid'),
+    batch_size: int = Option(20, help='Batch size'),
+    modes: int = Option(16, help='Number of Fourier modes'),
+    n_repeats: int = Option(20, help='Number of timed calls'),
+    seed: int = Option(38124, help='Seed value for reproducibility'),
+):
+    """Compare dense and factorized spectral weights of the F-FNO."""
+    torch.manual_seed(seed)
+
+    for width in widths:
+        # One axis of the truncated spectrum in the factorized block.
+        x = torch.randn(batch_size, width, grid_size, modes,
+                        dtype=torch.cfloat)
+        dense = torch.randn(width, width, modes, dtype=torch.cfloat)
+        elapsed = time_fn(lambda: contract_modes(x, dense, (3,)), n_repeats)
+        print(f'width {width:4d} | {"dense":12s} | '
+              f'{dense.numel() * 2:9,d} params | {elapsed * 1000:8.2f} ms')
+
+        for factorization in ['cp', 'tucker']:
+            for rank in ranks:
+                weight = FactorizedSpectralWeight(width, width, (modes,),
+                                                  factorization, rank)
+                n_params = sum(p.numel() for p in weight.parameters())
+                elapsed = time_fn(lambda: weight(x, (3,)), n_repeats)
+                name = f'{factorization} r={rank}'
+                print(f'width {width:4d} | {name:12s} | '
+                      f'{n_params:9,d} params | {elapsed * 1000:8.2f} ms')
+
+
+@app.command()
+def grouped(
+    group_widths: List[int] = Option([8, 16, 32], help='Channels per group'),
+    widths: List[int] = Option([64, 128, 256],
+                               help='Numbers of hidden channels'),
+    grid_size: int = Option(64, help='Width of the grid'),
+    batch_size: int = Option(20, help='Batch size'),
+    modes: int = Option(16, help='Number of Fourier modes'),
+    n_repeats: int = Option(20, help='Number of timed calls'),
+    seed: int = Option(38124, help='Seed value for reproducibility'),
+):
+    """Compare dense and grouped channel mixing in the spectral layers."""
+    torch.manual_seed(seed)
+
+    for width in widths:
+        # One axis of the truncated spectrum in the factorized block.
+        x = torch.randn(batch_size, width, grid_size, modes,
+                        dtype=torch.cfloat)
+        n_points = batch_size * grid_size * modes
+
+        for group_width in [width, *group_widths]:
+            if group_width > width:
+                continue
+            n_groups = width // group_width
+            weight = torch.randn(n_groups, group_width, group_width, modes,
+                                 dtype=torch.cfloat)
+            if n_groups == 1:
+                fn = partial(contract_modes, x, weight[0], (3,))
+            else:
+                fn = partial(contract_groups, x, weight, (3,))
+            # Each complex multiply-add takes 8 real flops.
+            gflops = 8 * n_points * width * group_width / 1e9
+            elapsed = time_fn(fn, n_repeats)
+            print(f'width {width:4d} | group width {group_width:4d} | '
+                  f'{weight.numel() * 2:9,d} params | {gflops:6.2f} GFLOP | '
+                  f'{elapsed * 1000:8.2f} ms')
+
+
+@app.command()
+def forecast_head(
+    grid_size: int = Option(64, help='Width of the grid'),
+    batch_size: int = Option(20, help='Batch size'),
+    n_repeats: int = Option(10, help='Number of timed calls'),
+    seed: int = Option(38124, help='Seed value for reproducibility'),
+):
+    """Compare per-layer and deferred forecast heads with use_fork."""
+    torch.manual_seed(seed)
+    x = torch.randn(batch_size, grid_size, grid_size, 3)
+    block = build_block(use_fork=True)
+    deferred = build_block(use_fork=True, defer_forecast_head=True)
+    deferred.load_state_dict(block.state_dict())
+    block.eval()
+    deferred.eval()
+
+    with torch.no_grad():
+        diff = (block(x)['forecast'] -
+                deferred(x)['forecast']).abs().max().item()
+    print(f'max abs difference: {diff:.2e}')
+
+    for name, model in [('per-layer', block), ('deferred', deferred)]:
+        elapsed = time_fn(lambda: model(x), n_repeats)
+        print(f'{name:9} | {elapsed * 1000:8.2f} ms')
+
+
+@app.command()
+def layer_capture(
+    grid_size: int = Option(64, help='Width of the grid'),
+    batch_size: int = Option(20, help='Batch size'),
+    n_steps: int = Option(10, help='Number of rollout steps'),
+    seed: int = Option(38124, help='Seed value for reproducibility'),
+):
+    """Compare allocations of validation rollouts with and without capture."""
+    torch.manual_seed(seed)
+    routine = build_routine(n_steps, use_fork=True)
+    batch = {'data': torch.randn(batch_size, grid_size, grid_size,
+                                 n_steps + 1)}
+
+    for name, step in [('no capture', None), ('capture last', n_steps - 1)]:
+        n_bytes = allocated_bytes(lambda: routine._valid_step(batch, step))
+        print(f'{name:12} | {n_bytes / 2**20:8.1f} MB allocated')
+
+    # Keeping the forecast of every layer at every step, as validation used
+    # to, would hold on to this much until the end of the batch.
+    n_retained = n_steps * routine.conv.n_layers * batch_size * grid_size**2
+    print(f'retained forecast_list: {n_retained * 4 / 2**20:.1f} MB')
+
+
+@app.command()
+def spectral_stream(
+    grid_sizes: List[int] = Option([64, 256], help='Widths of the grid'),
+    batch_size: int = Option(4, help='Batch size'),
+    n_repeats: int = Option(5, help='Number of timed calls'),
+    seed: int = Option(38124, help='Seed value for reproducibility'),
+):
+    """Compare the standard block with one that reuses input spectra."""
+    torch.manual_seed(seed)
+    block = build_block()
+    stream = build_block(spectral_stream=True)
+    stream.load_state_dict(block.state_dict())
+
+    for grid_size in grid_sizes:
+        x = torch.randn(batch_size, grid_size, grid_size, 3)
+        with torch.no_grad():
+            diff = (block(x)['forecast'] -
+                    stream(x)['forecast']).abs().max().item()
+        for name, model in [('standard', block), ('stream', stream)]:
+            elapsed = time_fn(lambda: model(x), n_repeats)
+            print(f'grid {grid_size:4d} | {name:8} | '
+                  f'{elapsed * 1000:8.2f} ms')
+        print(f'grid {grid_size:4d} | max abs difference: {diff:.2e}')
+
+
+@app.command()
+def lean_backward(
+    grid_size: int = Option(64, help='Width of the grid'),
+    batch_size: int = Option(19, help='Batch size'),
+    n_repeats: int = Option(3, help='Number of timed calls'),
+    seed: int = Option(38124, help='Seed value for reproducibility'),
+):
+    """Compare training memory with and without recomputed spectra."""
+    torch.manual_seed(seed)
+
+    # A small layer in double precision is enough to check the gradients.
+    layer = build_spectral_conv(4, 3, recompute_spectra=True).double()
+    x = torch.randn(2, 8, 8, 4, dtype=torch.double, requires_grad=True)
+    passed = torch.autograd.gradcheck(
+        lambda x, *params: layer.forward_fourier(x),
+        (x, *layer.fourier_weight))
+    print(f'gradcheck passed: {passed}')
+
+    x = torch.randn(batch_size, grid_size, grid_size, 3)
+    state = build_block().state_dict()
+    for recompute in [False, True]:
+        block = build_block(recompute_spectra=recompute)
+        block.load_state_dict(state)
+        block.train()
+
+        def step():
+            block.zero_grad()
+            block(x)['forecast'].sum().backward()
+
+        n_bytes = saved_activation_bytes(lambda: block(x))
+        step()
+        start = time.perf_counter()
+        for _ in range(n_repeats):
+            step()
+        elapsed = (time.perf_counter() - start) / n_repeats
+        name = 'recompute' if recompute else 'standard'
+        print(f'{name:9} | {n_bytes / 2**20:8.1f} MB saved | '
+              f'{elapsed * 1000:8.1f} ms per step')
+
+
+@app.command()
+def mode_pruning(
+    tolerances: List[float] = Option([1e-4, 1e-3, 1e-2],
+                                     help='Fractions of energy to drop'),
+    grid_size: int = Option(64, help='Width of the grid'),
+    batch_size: int = Option(4, help='Batch size'),
+    n_steps: int = Option(10, help='Number of rollout steps'),
+    n_repeats: int = Option(5, help='Number of timed rollouts'),
+    config_dir: Optional[str] = Option(
+        None, help='Experiment whose trained routine and data to use'),
+    trial: int = Option(0, help='Trial of the experiment'),
+    n_calibration: int = Option(2, help='Number of calibration batches'),
+    share_weight: bool = Option(True, help='Share the random spectral weights '
+                                'across layers'),
+    seed: int = Option(38124, help='Seed value for reproducibility'),
+):
+    """Compare rollout speed and error before and after mode pruning.
+
+    With an experiment, the trained routine is calibrated on batches of its
+    validation split, and the losses are over its test split. Otherwise, a
+    random routine is calibrated and run on random data.
+    """
+    torch.manual_seed(seed)
+    if config_dir:
+        routine, builder = load_experiment(config_dir, trial)
+        val_batches = iter(builder.val_dataloader())
+        calibration = [next(val_batches) for _ in range(n_calibration)]
+        test_batches = list(builder.test_dataloader())
+        data = test_batches[0]['data']
+        n_steps = routine.n_steps
+    else:
+        routine = build_routine(n_steps, share_weight=share_weight)
+        calibration = [{'data': torch.randn(batch_size, grid_size, grid_size,
+                                            n_steps + 1)}
+                       for _ in range(n_calibration)]
+        data = torch.randn(batch_size, grid_size, grid_size, n_steps + 1)
+        test_batches = [{'data': data}]
+
+    def n_params(model):
+        return sum(p.numel() for p in model.conv.parameters())
+
+    with torch.no_grad():
+        preds = routine(data)[2]
+    loss = rollout_loss(routine, test_batches)
+    elapsed = time_fn(lambda: routine(data), n_repeats)
+    print(f'full modes    | {elapsed / n_steps * 1000:8.2f} ms per step | '
+          f'loss {loss:.5f} | {n_params(routine)} params')
+
+    for tolerance in tolerances:
+        pruned = deepcopy(routine)
+        modes = pruned.prune_spectral_modes(calibration, tolerance)
+        with torch.no_grad():
+            pruned_preds = pruned(data)[2]
+        pruned_loss = rollout_loss(pruned, test_batches)
+        change = (pruned_preds - preds).norm() / preds.norm()
+        pruned_elapsed = time_fn(lambda: pruned(data), n_repeats)
+        mean_modes = sum(sum(m) for m in modes) / (2 * len(modes))
+
+        # The pruning must survive a round trip through the state dict.
+        reloaded = deepcopy(routine)
+        reloaded.load_state_dict(pruned.state_dict())
+        with torch.no_grad():
+            reload_diff = (reloaded(data)[2] - pruned_preds).abs().max()
+
+        print(f'tol {tolerance:.0e} | '
+              f'{pruned_elapsed / n_steps * 1000:8.2f} ms per step | '
+              f'loss {pruned_loss:.5f} | '
+              f'speedup {elapsed / pruned_elapsed:5.2f}x | '
+              f'relative change {change.item():.2e} | '
+              f'mean modes {mean_modes:5.1f} | '
+              f'{n_params(pruned)} params | '
+              f'reload diff {reload_diff.item():.1e}')
+
+
+@app.command()
+def factorized_3d(
+    grid_sizes: List[int] = Option([32, 48, 64], help='Widths of the grid'),
+    batch_size: int = Option(2, help='Batch size'),
+    width: int = Option(32, help='Number of hidden channels'),
+    modes: int = Option(8, help='Number of Fourier modes'),
+    n_repeats: int = Option(5, help='Number of timed calls'),
+    seed: int = Option(38124, help='Seed value for reproducibility'),
+):
+    """Compare factorized and dense 3D spectral layers."""
+    torch.manual_seed(seed)
+    layer = SpectralConv3d(width, width, modes, forecast_ff=None,
+                           backcast_ff=None, fourier_weight=None, factor=4,
+                           ff_weight_norm=False, n_ff_layers=2,
+                           layer_norm=False, use_fork=False, dropout=0.0,
+                           mode='full').eval()
+    dense_weights = torch.randn(4, width, width, modes, modes, modes,
+                                dtype=torch.cfloat)
+    n_factorized = sum(w.numel() for w in layer.fourier_weight)
+    n_dense = dense_weights.numel() * 2
+    print(f'spectral params | factorized {n_factorized:,d} | '
+          f'dense {n_dense:,d}')
+
+    for grid_size in grid_sizes:
+        x = torch.randn(batch_size, grid_size, grid_size, grid_size, width)
+        x_cf = rearrange(x, 'b m n l i -> b i m n l')
+        fns = [('factorized', lambda: layer.forward_fourier(x)),
+               ('dense', lambda: dense_spectral_conv_3d(
+                   x_cf, dense_weights, modes))]
+        for name, fn in fns:
+            elapsed = time_fn(fn, n_repeats)
+            n_bytes = allocated_bytes(fn)
+            throughput = batch_size / elapsed
+            print(f'grid {grid_size:3d}^3 | {name:10} | '
+                  f'{elapsed * 1000:9.2f} ms | '
+                  f'{n_bytes / 2**20:8.1f} MB | '
+                  f'{throughput:7.1f} samples/s')
+
+
+@app.command()
+def multi_frame(
+    frames: List[int] = Option([1, 2, 5], help='Frames per forward pass'),
+    checkpoint_paths: Optional[List[str]] = Option(
+        None, help='Trained checkpoint for each entry of --frames'),
+    data_path: Optional[str] = Option(
+        None, help='.mat file whose last samples are used for evaluation'),
+    grid_size: int = Option(64, help='Width of the grid'),
+    batch_size: int = Option(20, help='Batch size'),
+    n_steps: int = Option(10, help='Number of rollout steps'),
+    n_repeats: int = Option(3, help='Number of timed rollouts'),
+    seed: int = Option(38124, help='Seed value for reproducibility'),
+):
+    """Compare rollout latency and loss across frames per forward pass."""
+    torch.manual_seed(seed)
+    if data_path:
+        u = scipy.io.loadmat(data_path)['u'].astype(np.float32)
+        data = torch.from_numpy(u[-batch_size:, ..., -n_steps - 1:])
+    else:
+        data = torch.randn(batch_size, grid_size, grid_size, n_steps + 1)
+
+    for i, n_frames in enumerate(frames):
+        routine = build_routine(n_steps, n_frames=n_frames)
+        if checkpoint_paths:
+            routine.load_lightning_model_state(checkpoint_paths[i], 'cpu')
+        with torch.no_grad():
+            loss = routine(data)[1]
+        elapsed = time_fn(lambda: routine(data), n_repeats)
+        n_calls = -(-n_steps // n_frames)
+        print(f'{n_frames:2d} frames | {n_calls:2d} forward passes | '
+              f'{elapsed * 1000:8.1f} ms per rollout | '
+              f'loss {loss.item():.5f}')
+
+
+@app.command()
+def latent_rollout(
+    grid_size: int = Option(64, help='Width of the grid'),
+    batch_size: int = Option(4, help='Batch size'),
+    n_steps: int = Option(10, help='Number of rollout steps'),
+    n_repeats: int = Option(5, help='Number of timed rollouts'),
+    use_fork: bool = Option(False, help='Use the forecast fork'),
+    seed: int = Option(38124, help='Seed value for reproducibility'),
+):
+    """Compare rollouts in physical and latent space."""
+    torch.manual_seed(seed)
+    routine = build_routine(n_steps, use_fork=use_fork)
+    latent = deepcopy(routine)
+    latent.latent_rollout = True
+    data = torch.randn(batch_size, grid_size, grid_size, n_steps + 1)
+
+    with torch.no_grad():
+        preds = routine(data)[2]
+        latent_preds = latent(data)[2]
+    diff = (preds - latent_preds).abs().max().item()
+
+    for name, model in [('physical', routine), ('latent', latent)]:
+        elapsed = time_fn(lambda: model(data), n_repeats)
+        print(f'{name:8} | {elapsed / n_steps * 1000:8.2f} ms per step')
+
+    # The part of each step that the latent rollout replaces: building,
+    # normalizing and projecting the inputs, against a single multiply-add.
+    x = torch.randn(batch_size, grid_size, grid_size, routine.conv.input_dim)
+    with torch.no_grad():
+        frame, cond, proj = latent._encode_conditioning(x[..., None, :])[:3]
+
+    def physical_inputs():
+        features = torch.cat([x[..., :1], x[..., 1:]], dim=-1)
+        return routine.conv.in_proj(routine.normalizer(features))
+
+    for name, fn in [('physical', physical_inputs),
+                     ('latent', lambda: cond + proj * frame)]:
+        elapsed = time_fn(fn, n_repeats * 10)
+        print(f'{name:8} | {elapsed * 1000:8.3f} ms per input stage')
+    print(f'max abs difference: {diff:.2e}')
+
+
+@app.command()
+def coarse_grid(
+    coarse_sizes: List[int] = Option([32],
+                                     help='Grid sizes to run the conv on'),
+    data_paths: Optional[List[str]] = Option(
+        None, help='.mat files whose last samples are used for evaluation'),
+    checkpoint_path: Optional[str] = Option(
+        None, help='Lightning checkpoint of a trained routine'),
+    grid_size: int = Option(64, help='Width of the grid without data'),
+    batch_size: int = Option(20, help='Batch size'),
+    n_steps: int = Option(10, help='Number of rollout steps'),
+    n_repeats: int = Option(3, help='Number of timed rollouts'),
+    seed: int = Option(38124, help='Seed value for reproducibility'),
+):
+    """Compare throughput and loss of rollouts on coarser grids."""
+    torch.manual_seed(seed)
+    routine = build_routine(n_steps)
+    if checkpoint_path:
+        routine.load_lightning_model_state(checkpoint_path, 'cpu')
+
+    datasets = {}
+    for path in data_paths or []:
+        u = scipy.io.loadmat(path)['u'].astype(np.float32)
+        datasets[path] = torch.from_numpy(u[-batch_size:, ..., -n_steps - 1:])
+    if not datasets:
+        datasets['random'] = torch.randn(batch_size, grid_size, grid_size,
+                                         n_steps + 1)
+
+    for name, data in datasets.items():
+        routine.coarse_grid_size = None
+        with torch.no_grad():
+            loss = routine(data)[1].item()
+        elapsed = time_fn(lambda: routine(data), n_repeats)
+        print(f'{name} | full grid | {batch_size / elapsed:7.2f} samples/s | '
+              f'loss {loss:.5f}')
+
+        for size in coarse_sizes:
+            routine.coarse_grid_size = size
+            with torch.no_grad():
+                coarse_loss = routine(data)[1].item()
+            coarse_elapsed = time_fn(lambda: routine(data), n_repeats)
+            print(f'{name} | {size:4d} grid | '
+                  f'{batch_size / coarse_elapsed:7.2f} samples/s | '
+                  f'loss {coarse_loss:.5f} | '
+                  f'speedup {elapsed / coarse_elapsed:5.2f}x | '
+                  f'loss change {coarse_loss - loss:+.5f}')
+
+
+@app.command()
+def ns_solver(
+    grid_sizes: List[int] = Option([64, 256, 512], help='Widths of the grid'),
+    batch_size: int = Option(4, help='Batch size'),
+    n_steps: int = Option(100, help='Number of solver steps'),
+    delta_t: float = Option(1e-4, help='Solver time step'),
+    visc: float = Option(1e-5, help='Viscosity'),
+    seed: int = Option(38124, help='Seed value for reproducibility'),
+):
+    """Compare the real and full-spectrum Navier-Stokes solvers."""
+    torch.manual_seed(seed)
+    T = n_steps * delta_t
+
+    for N in grid_sizes:
+        sampler = GaussianRF(2, N, alpha=2.5, tau=7, device='cpu')
+        w0 = sampler.sample(batch_size)
+        solvers = [
+            ('full', lambda: fftn_navier_stokes_2d(w0, visc, T, delta_t, 1)),
+            ('real', lambda: solve_navier_stokes_2d(
+                w0, visc, T, delta_t, 1, force=Force.li)[0])]
+        sols = {}
+        for name, solver in solvers:
+            start = time.perf_counter()
+            sols[name] = solver()
+            elapsed = time.perf_counter() - start
+            print(f'N {N:4d} | {name:4} | {n_steps / elapsed:8.1f} steps/s')
+        error = np.abs(sols['full'] - sols['real']).max() / \
+            np.abs(sols['full']).max()
+        print(f'N {N:4d} | max relative difference: {error:.2e}')
+
+
+@app.command()
+def random_force(
+    grid_size: int = Option(256, help='Width of the grid'),
+    batch_size: int = Option(4, help='Batch size'),
+    cycles: int = Option(2, help='Number of cycles in forcing function'),
+    scaling: float = Option(0.1, help='Scaling of forcing function'),
+    t_scaling: float = Option(0.2, help='Scaling of time variable'),
+    n_repeats: int = Option(20, help='Number of timing repeats'),
+    seed: int = Option(38124, help='Seed value for the force'),
+):
+    """Compare building time-varying forces on the grid and spectrally."""
+    s, b = grid_size, batch_size
+    force = SpectralRandomForce(b, s, 'cpu', cycles, scaling, t_scaling, seed)
+
+    def grid_spectrum(t):
+        f = get_random_force(b, s, 'cpu', cycles, scaling, t, t_scaling, seed)
+        return torch.fft.rfft2(f, dim=[-2, -1], norm='backward')
+
+    error = 0
+    for t in [0.0, 1.3, 17.9]:
+        f = get_random_force(b, s, 'cpu', cycles, scaling, t, t_scaling, seed)
+        error = max(error, ((f - force.field(t)).abs().max() /
+                            f.abs().max()).item())
+
+    grid_time = time_fn(lambda: grid_spectrum(1.3), n_repeats)
+    spectral_time = time_fn(lambda: force.spectrum(1.3), n_repeats)
+    print(f'grid     | {grid_time * 1000:8.3f} ms/step')
+    print(f'spectral | {spectral_time * 1000:8.3f} ms/step')
+    print(f'max relative difference of fields: {error:.2e}')
+
+
+if __name__ == "__main__":
+    app()
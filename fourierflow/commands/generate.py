@@ -1,4 +1,7 @@
 import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from multiprocessing import get_context
 
 import h5py
 import numpy as np
@@ -7,12 +10,123 @@ import torch
 from einops import repeat
 from typer import Argument, Option, Typer
 
-from fourierflow.builders.synthetic import (Force, GaussianRF,
+from fourierflow.builders.synthetic import (Force, GaussianRF, SnapshotWriter,
                                             solve_navier_stokes_2d)
 
 app = Typer()
 
 
+def create_split_datasets(group, n, s, steps, varying_force):
+    group.create_dataset('a', (n, s, s), np.float32)
+    if varying_force:
+        group.create_dataset('f', (n, s, s, steps), np.float32)
+    else:
+        group.create_dataset('f', (n, s, s), np.float32)
+    group.create_dataset('u', (n, s, s, steps), np.float32)
+    group.create_dataset('mu', (n,), np.float32)
+
+
+def generate_shard(shard_path, seed, b, s, t, steps, delta, mu, mu_min,
+                   mu_max, force, cycles, scaling, t_scaling, varying_force,
+                   n_threads):
+    """Solve one batch on the CPU and write it to its own HDF5 file.
+
+    The shard is written under a temporary name and renamed once complete,
+    so a shard that exists is always whole.
+    """
+    if os.path.exists(shard_path):
+        return
+
+    torch.set_num_threads(n_threads)
+    torch.manual_seed(seed)
+    np.random.seed((seed + 1234) % 2**32)
+    GRF = GaussianRF(2, s, alpha=2.5, tau=7, device='cpu')
+
+    tmp_path = f'{shard_path}.tmp'
+    with h5py.File(tmp_path, 'w') as shard_f, torch.no_grad():
+        create_split_datasets(shard_f, b, s, steps, varying_force)
+        f_data = None
+        if force == Force.random and varying_force:
+            f_data = shard_f['f']
+
+        w0 = GRF.sample(b)
+        if mu_min != mu_max:
+            mu = np.random.rand(b) * (mu_max - mu_min) + mu_min
+
+        with SnapshotWriter(shard_f['u'], f_data) as writer:
+            _, f = solve_navier_stokes_2d(
+                w0, mu, t, delta, steps, cycles,
+                scaling, t_scaling, force, varying_force,
+                sink=partial(writer.put, 0))
+        shard_f['a'][...] = w0.numpy()
+        if force == Force.random and not varying_force:
+            shard_f['f'][...] = f
+        shard_f['mu'][...] = mu
+
+    os.replace(tmp_path, shard_path)
+
+
+def generate_sharded(path, n_workers, n_train, n_valid, n_test, s, t, steps,
+                     mu, mu_min, mu_max, seed, delta, batch_size, force,
+                     cycles, scaling, t_scaling, varying_force):
+    """Generate the splits on a pool of CPU processes.
+
+    Each batch is solved by one worker with a seed derived from the base seed,
+    the split and the batch index, so the output doesn't depend on the number
+    of workers or the order the batches finish in. Batches go to their own
+    shard files next to path, and shards that already exist are skipped, so
+    an interrupted run picks up where it stopped. The shards are merged into
+    path once all of them are done.
+    """
+    shard_dir = f'{path}.shards'
+    os.makedirs(shard_dir, exist_ok=True)
+    n_threads = max(1, os.cpu_count() // n_workers)
+
+    splits = [('train', n_train), ('valid', n_valid), ('test', n_test)]
+    kwargs = dict(s=s, t=t, steps=steps, delta=delta, mu=mu, mu_min=mu_min,
+                  mu_max=mu_max, force=force, cycles=cycles, scaling=scaling,
+                  t_scaling=t_scaling, varying_force=varying_force,
+                  n_threads=n_threads)
+
+    shards = {}
+    jobs = []
+    for i, (split, n) in enumerate(splits):
+        b = min(n, batch_size)
+        shards[split] = []
+        for j in range(n // b):
+            shard_path = os.path.join(shard_dir, f'{split}_{j:05d}.h5')
+            state = np.random.SeedSequence([seed, i, j]).generate_state(1)
+            shards[split].append((shard_path, b))
+            jobs.append((shard_path, int(state[0]), b))
+
+    # Spawn rather than fork, as forking a process that has already started
+    # torch's thread pools can deadlock.
+    context = get_context('spawn')
+    with ProcessPoolExecutor(n_workers, mp_context=context) as executor:
+        futures = [executor.submit(generate_shard, shard_path, job_seed, b,
+                                   **kwargs)
+                   for shard_path, job_seed, b in jobs]
+        for k, future in enumerate(futures):
+            future.result()
+            print(f'Finished batch {k + 1} of {len(futures)}')
+
+    with h5py.File(path, 'a') as data_f:
+        for split, _ in splits:
+            print('Merging split:', split)
+            if split in data_f:
+                del data_f[split]
+            n = sum(b for _, b in shards[split])
+            group = data_f.create_group(split)
+            create_split_datasets(group, n, s, steps, varying_force)
+
+            c = 0
+            for shard_path, b in shards[split]:
+                with h5py.File(shard_path, 'r') as shard_f:
+                    for key in ['a', 'f', 'u', 'mu']:
+                        group[key][c:c + b] = shard_f[key][...]
+                c += b
+
+
 @app.command()
 def navier_stokes(
     path: str = Argument(..., help='Path to store the generated samples'),
@@ -33,6 +147,8 @@ def navier_stokes(
     scaling: float = Option(0.1, help='Scaling of forcing function'),
     t_scaling: float = Option(0.2, help='Scaling of time variable'),
     varying_force: bool = Option(False, help='Enable time-varying force'),
+    n_workers: int = Option(0, help='Number of CPU worker processes. If '
+                            'zero, batches are solved one by one on the GPU'),
     debug: bool = Option(False, help='Enable debugging mode with ptvsd'),
 ):
     # This debug mode is for those who use VS Code's internal debugger.
@@ -40,6 +156,12 @@ def navier_stokes(
         ptvsd.enable_attach(address=('0.0.0.0', 5678))
         ptvsd.wait_for_attach()
 
+    if n_workers > 0:
+        generate_sharded(path, n_workers, n_train, n_valid, n_test, s, t,
+                         steps, mu, mu_min, mu_max, seed, delta, batch_size,
+                         force, cycles, scaling, t_scaling, varying_force)
+        return
+
     device = torch.device('cuda')
     torch.manual_seed(seed)
     np.random.seed(seed + 1234)
@@ -54,17 +176,19 @@ def navier_stokes(
 
     def generate_split(n, split):
         print('Generating split:', split)
-        data_f.create_dataset(f'{split}/a', (n, s, s), np.float32)
-        if varying_force:
-            data_f.create_dataset(f'{split}/f', (n, s, s, steps), np.float32)
-        else:
-            data_f.create_dataset(f'{split}/f', (n, s, s), np.float32)
-        data_f.create_dataset(f'{split}/u', (n, s, s, steps), np.float32)
-        data_f.create_dataset(f'{split}/mu', (n,), np.float32)
+        create_split_datasets(data_f.create_group(split), n, s, steps,
+                              varying_force)
         b = min(n, batch_size)
         c = 0
 
-        with torch.no_grad():
+        # Snapshots are written by a background thread as soon as the solver
+        # records them, so they are never all held in memory.
+        f_data = None
+        if force == Force.random and varying_force:
+            f_data = data_f[f'{split}/f']
+        writer = SnapshotWriter(data_f[f'{split}/u'], f_data)
+
+        with torch.no_grad(), writer:
             for j in range(n // b):
                 print('batch', j)
                 w0 = GRF.sample(b)
@@ -72,13 +196,13 @@ def navier_stokes(
                 if mu_min != mu_max:
                     mu = np.random.rand(b) * (mu_max - mu_min) + mu_min
 
-                sol, f = solve_navier_stokes_2d(
+                _, f = solve_navier_stokes_2d(
                     w0, mu, t, delta, steps, cycles,
-                    scaling, t_scaling, force, varying_force)
+                    scaling, t_scaling, force, varying_force,
+                    sink=partial(writer.put, c))
                 data_f[f'{split}/a'][c:(c+b), ...] = w0.cpu().numpy()
-                data_f[f'{split}/u'][c:(c+b), ...] = sol
 
-                if force == Force.random:
+                if force == Force.random and not varying_force:
                     data_f[f'{split}/f'][c:(c+b), ...] = f
 
                 data_f[f'{split}/mu'][c:(c+b)] = mu
@@ -27,6 +27,8 @@ def main(config_dir: Optional[str] = Argument(None),
          overrides: Optional[List[str]] = Argument(None),
          trial: Optional[int] = None,
          map_location: Optional[str] = None,
+         device: str = 'cuda',
+         quantize: bool = False,
          debug: bool = False):
     """Test a Pytorch Lightning experiment."""
     if not config_dir:
@@ -85,18 +87,44 @@ def main(config_dir: Optional[str] = Argument(None),
         test_ds['vorticity'] = xru.vorticity_2d(test_ds)
         test_w = test_ds['vorticity'].values
         test_w = test_w.transpose(0, 2, 3, 1)
-        data = torch.from_numpy(test_w).cuda()[0:1]
+        data = torch.from_numpy(test_w).to(device)[0:1]
+        test_data = None
     else:
         data_path = 'data/fourier/NavierStokes_V1e-5_N1200_T20.mat'
-        data = scipy.io.loadmat(data_path)['u'].astype(np.float32)[:512]
-        data = torch.from_numpy(data).cuda()
+        u = scipy.io.loadmat(data_path)['u'].astype(np.float32)
+        data = torch.from_numpy(u[:512]).to(device)
+        test_size = config.builder.get('test_size', 200)
+        test_data = torch.from_numpy(u[-test_size:])
 
-    routine = routine.cuda()
+    routine = routine.to(device)
     start = time.time()
     with torch.no_grad():
         routine(data)
     elasped = time.time() - start
     wandb_logger.experiment.log({'inference_time': elasped})
+    print(f'inference time: {elasped:.3f}s')
+
+    if quantize:
+        # Dynamic int8 kernels only run on the CPU, so the float model is
+        # timed on the CPU too for a fair comparison.
+        routine = routine.cpu()
+        quantized = deepcopy(routine).quantize_for_inference()
+        data = data.cpu()
+
+        results = {}
+        for name, model in [('cpu', routine), ('quantized', quantized)]:
+            start = time.time()
+            with torch.no_grad():
+                model(data)
+            results[f'{name}_inference_time'] = time.time() - start
+            if test_data is not None:
+                with torch.no_grad():
+                    loss_full = model(test_data)[1]
+                results[f'{name}_test_loss'] = loss_full.item()
+
+        wandb_logger.experiment.log(results)
+        for key, value in results.items():
+            print(f'{key}: {value:.5f}')
 
 
 if __name__ == "__main__":
@@ -1,4 +1,5 @@
 from .fno_factorized_2d import FNOFactorized2DBlock
+from .fno_factorized_3d import FNOFactorized3DBlock
 from .fno_plus_2d import FNOPlus2DBlock
 from .fno_zongyi_2d import FNOZongyi2DBlock
 from .linear import GehringLinear, WNLinear
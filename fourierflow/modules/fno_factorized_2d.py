@@ -1,23 +1,57 @@
 
+import math
+
 import torch
 import torch.nn as nn
 from einops import rearrange
+from torch.utils.checkpoint import checkpoint
 
 from .linear import WNLinear
+from .spectral import (FactorizedSpectralWeight, RecomputeSpectra,
+                       contract_groups, contract_modes, full_precision,
+                       new_fourier_weight, resample_grid)
+
+
+class ChannelsFirstLayerNorm(nn.LayerNorm):
+    """Layer norm over dimension 1 for inputs whose channels come first."""
+
+    def forward(self, x):
+        # x.shape == [batch_size, dim, *dim_sizes]
+        mean = x.mean(dim=1, keepdim=True)
+        var = x.var(dim=1, unbiased=False, keepdim=True)
+        x = (x - mean) / torch.sqrt(var + self.eps)
+        if self.elementwise_affine:
+            shape = [-1] + [1] * (x.ndim - 2)
+            x = x * self.weight.view(shape) + self.bias.view(shape)
+        return x
+
+
+def truncated_spectra(x, n_modes):
+    # x.shape == [batch_size, dim, grid_size, grid_size]
+    x_fty = torch.fft.rfft(x, dim=-1, norm='ortho')[..., :n_modes]
+    # x_fty.shape == [batch_size, dim, grid_size, n_modes]
+
+    x_ftx = torch.fft.rfft(x, dim=-2, norm='ortho')[..., :n_modes, :]
+    # x_ftx.shape == [batch_size, dim, n_modes, grid_size]
+
+    return x_fty, x_ftx
 
 
 class FeedForward(nn.Module):
-    def __init__(self, dim, factor, ff_weight_norm, n_layers, layer_norm, dropout):
+    def __init__(self, dim, factor, ff_weight_norm, n_layers, layer_norm, dropout,
+                 channels_first=False):
         super().__init__()
+        LayerNorm = ChannelsFirstLayerNorm if channels_first else nn.LayerNorm
         self.layers = nn.ModuleList([])
         for i in range(n_layers):
             in_dim = dim if i == 0 else dim * factor
             out_dim = dim if i == n_layers - 1 else dim * factor
             self.layers.append(nn.Sequential(
-                WNLinear(in_dim, out_dim, wnorm=ff_weight_norm),
+                WNLinear(in_dim, out_dim, wnorm=ff_weight_norm,
+                         channels_first=channels_first),
                 nn.Dropout(dropout),
                 nn.ReLU(inplace=True) if i < n_layers - 1 else nn.Identity(),
-                nn.LayerNorm(out_dim) if layer_norm and i == n_layers -
+                LayerNorm(out_dim) if layer_norm and i == n_layers -
                 1 else nn.Identity(),
             ))
 
@@ -30,7 +64,10 @@ class FeedForward(nn.Module):
 class SpectralConv2d(nn.Module):
     def __init__(self, in_dim, out_dim, n_modes, forecast_ff, backcast_ff,
                  fourier_weight, factor, norm_locs, group_width, ff_weight_norm,
-                 n_ff_layers, layer_norm, use_fork, dropout, mode):
+                 n_ff_layers, layer_norm, use_fork, dropout, mode,
+                 channels_first=False, fuse_axes=False,
+                 spectral_backend='einsum', weight_factorization=None,
+                 weight_rank=16, recompute_spectra=False):
         super().__init__()
         self.in_dim = in_dim
         self.out_dim = out_dim
@@ -39,122 +76,283 @@ class SpectralConv2d(nn.Module):
         self.group_width = group_width
         self.mode = mode
         self.use_fork = use_fork
+        self.channels_first = channels_first
+        self.spectral_backend = spectral_backend
+        self.weight_factorization = weight_factorization
+        # Recompute the spectra in the backward pass instead of keeping them.
+        self.recompute_spectra = recompute_spectra
+        # The number of modes used along the y and x axes, which pruning can
+        # lower after training. The buffer saves them with the weights, and
+        # n_active_modes mirrors them on the host so that forward passes don't
+        # have to read them back from the device. While mode_energy is a list,
+        # the energy of the mixed spectrum in each mode is accumulated into it,
+        # one tensor per axis.
+        self.register_buffer('active_modes', torch.tensor([n_modes, n_modes]))
+        self.n_active_modes = [n_modes, n_modes]
+        self.mode_energy = None
+        # Weights shared with other layers can't be sliced when this layer is
+        # pruned, so the higher modes are skipped at runtime instead.
+        self.shared_weight = bool(fourier_weight)
+
+        # Channels are only mixed within groups of group_width channels.
+        self.n_groups = in_dim // group_width if group_width else 1
+        if self.n_groups > 1 and weight_factorization:
+            raise ValueError('Grouped weights cannot also be factorized')
+        # Fusing stacks the weights of both axes, which only works when they
+        # are plain dense tensors.
+        self.fuse_axes = fuse_axes and self.n_groups == 1 and \
+            not weight_factorization
 
         self.fourier_weight = fourier_weight
+        if not self.fourier_weight and weight_factorization:
+            self.fourier_weight = nn.ModuleList([
+                FactorizedSpectralWeight(in_dim, out_dim, (n_modes,),
+                                         weight_factorization, weight_rank)
+                for _ in range(2)])
         # Can't use complex type yet. See https://github.com/pytorch/pytorch/issues/59998
-        if not self.fourier_weight:
-            self.fourier_weight = nn.ParameterList([])
-            for _ in range(2):
-                weight = torch.FloatTensor(in_dim, out_dim, n_modes, 2)
-                param = nn.Parameter(weight)
-                nn.init.xavier_normal_(param)
-                self.fourier_weight.append(param)
+        elif not self.fourier_weight:
+            self.fourier_weight = nn.ParameterList([
+                new_fourier_weight(in_dim, out_dim, (n_modes,), group_width)
+                for _ in range(2)])
 
         if use_fork:
             self.forecast_ff = forecast_ff
             if not self.forecast_ff:
                 self.forecast_ff = FeedForward(
-                    out_dim, factor, ff_weight_norm, n_ff_layers, layer_norm, dropout)
+                    out_dim, factor, ff_weight_norm, n_ff_layers, layer_norm,
+                    dropout, channels_first)
 
         self.backcast_ff = backcast_ff
         if not self.backcast_ff:
             self.backcast_ff = FeedForward(
-                out_dim, factor, ff_weight_norm, n_ff_layers, layer_norm, dropout)
-
-    def forward(self, x):
+                out_dim, factor, ff_weight_norm, n_ff_layers, layer_norm,
+                dropout, channels_first)
+
+    def prune_modes(self, n_modes):
+        """Only use the first n_modes[i] Fourier modes along axis i.
+
+        Weights that belong to this layer alone are sliced down to the kept
+        modes, so the pruned layer is also smaller.
+        """
+        self.active_modes.copy_(torch.tensor(n_modes))
+        self.n_active_modes = list(n_modes)
+        if not self.shared_weight:
+            self._slice_weights()
+
+    @torch.no_grad()
+    def _slice_weights(self):
+        # Weights that already have the right number of modes are left alone,
+        # so that optimizers holding them keep training the same parameters.
+        for i, n_modes in enumerate(self.n_active_modes):
+            weight = self.fourier_weight[i]
+            if isinstance(weight, FactorizedSpectralWeight):
+                factor = weight.mode_factors[0]
+                if factor.shape[0] > n_modes:
+                    weight.mode_factors[0] = nn.Parameter(
+                        factor[:n_modes].clone())
+            elif weight.shape[-2] > n_modes:
+                self.fourier_weight[i] = nn.Parameter(
+                    weight[..., :n_modes, :].clone())
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Checkpoints from before pruning existed use all the modes.
+        key = prefix + 'active_modes'
+        if key not in state_dict:
+            state_dict[key] = torch.tensor([self.n_modes, self.n_modes])
+
+        # The weights are loaded after this, so they must have been sliced
+        # to the pruned shapes by then.
+        self.n_active_modes = state_dict[key].tolist()
+        if not self.shared_weight:
+            self._slice_weights()
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def forward(self, x, x_ft=None):
         # x.shape == [batch_size, grid_size, grid_size, in_dim]
+        # or [batch_size, in_dim, grid_size, grid_size] if channels_first
+        # x_ft optionally holds the truncated spectra of x along each axis,
+        # as returned by truncated_spectra(), if they're already known.
         if self.mode != 'no-fourier':
-            x = self.forward_fourier(x)
+            x = full_precision(self.forward_fourier, x, x_ft)
 
         b = self.backcast_ff(x)
         f = self.forecast_ff(x) if self.use_fork else None
         return b, f
 
-    def forward_fourier(self, x):
-        x = rearrange(x, 'b m n i -> b i m n')
+    def contract(self, x, i, dims):
+        weight = self.fourier_weight[i]
+        if isinstance(weight, FactorizedSpectralWeight):
+            return weight(x, dims, self.spectral_backend)
+        # Only the modes that x still has after pruning are used.
+        weight = torch.view_as_complex(weight[..., :x.shape[dims[0]], :])
+        if self.n_groups > 1:
+            return contract_groups(x, weight, dims, self.spectral_backend)
+        return contract_modes(x, weight, dims, self.spectral_backend)
+
+    def forward_fourier(self, x, x_ft=None):
+        if not self.channels_first:
+            x = rearrange(x, 'b m n i -> b i m n')
         # x.shape == [batch_size, in_dim, grid_size, grid_size]
 
         B, I, M, N = x.shape
 
-        # # # Dimesion Y # # #
-        x_fty = torch.fft.rfft(x, dim=-1, norm='ortho')
-        # x_ft.shape == [batch_size, in_dim, grid_size, grid_size // 2 + 1]
+        fuse = self.fuse_axes and M == N and self.mode_energy is None and \
+            self.n_active_modes[0] == self.n_active_modes[1]
+        if x_ft is not None:
+            x = self.mix_axes(x, x_ft)
+        else:
+            mix = self.mix_axes_fused if fuse else self.mix_axes
+            if self.recompute_spectra and torch.is_grad_enabled():
+                params = list(self.fourier_weight.parameters())
+                x = RecomputeSpectra.apply(mix, x, *params)
+            else:
+                x = mix(x)
+        # x.shape == [batch_size, out_dim, grid_size, grid_size]
+
+        if not self.channels_first:
+            x = rearrange(x, 'b i m n -> b m n i')
+            # x.shape == [batch_size, grid_size, grid_size, out_dim]
+
+        return x
 
-        out_ft = x_fty.new_zeros(B, I, N, M // 2 + 1)
-        # out_ft.shape == [batch_size, in_dim, grid_size, grid_size // 2 + 1, 2]
+    def mix_axes(self, x, x_ft=None):
+        B, I, M, N = x.shape
+
+        # We only ever work with the first n_modes of each spectrum. irfft
+        # zero-pads its input up to n // 2 + 1, so there's no need to
+        # allocate and fill a full-sized output spectrum.
+        x_fty, x_ftx = x_ft or truncated_spectra(x, self.n_modes)
+        x_fty = x_fty[..., :self.n_active_modes[0]]
+        x_ftx = x_ftx[..., :self.n_active_modes[1], :]
+        # x_fty.shape == [batch_size, in_dim, grid_size, n_modes]
+        # x_ftx.shape == [batch_size, in_dim, n_modes, grid_size]
 
+        # # # Dimesion Y # # #
         if self.mode == 'full':
-            out_ft[:, :, :, :self.n_modes] = torch.einsum(
-                "bixy,ioy->boxy",
-                x_fty[:, :, :, :self.n_modes],
-                torch.view_as_complex(self.fourier_weight[0]))
+            out_ft = self.contract(x_fty, 0, dims=(3,))
         elif self.mode == 'low-pass':
-            out_ft[:, :, :, :self.n_modes] = x_fty[:, :, :, :self.n_modes]
+            out_ft = x_fty
+        # out_ft.shape == [batch_size, out_dim, grid_size, n_modes]
+
+        if self.mode_energy is not None:
+            energy = out_ft.abs().pow(2).sum(dim=(0, 1, 2)).detach()
+            self.mode_energy[0] = self.mode_energy[0] + energy
 
         xy = torch.fft.irfft(out_ft, n=N, dim=-1, norm='ortho')
-        # x.shape == [batch_size, in_dim, grid_size, grid_size]
+        # xy.shape == [batch_size, out_dim, grid_size, grid_size]
 
         # # # Dimesion X # # #
-        x_ftx = torch.fft.rfft(x, dim=-2, norm='ortho')
-        # x_ft.shape == [batch_size, in_dim, grid_size // 2 + 1, grid_size]
-
-        out_ft = x_ftx.new_zeros(B, I, N // 2 + 1, M)
-        # out_ft.shape == [batch_size, in_dim, grid_size // 2 + 1, grid_size, 2]
-
         if self.mode == 'full':
-            out_ft[:, :, :self.n_modes, :] = torch.einsum(
-                "bixy,iox->boxy",
-                x_ftx[:, :, :self.n_modes, :],
-                torch.view_as_complex(self.fourier_weight[1]))
+            out_ft = self.contract(x_ftx, 1, dims=(2,))
         elif self.mode == 'low-pass':
-            out_ft[:, :, :self.n_modes, :] = x_ftx[:, :, :self.n_modes, :]
+            out_ft = x_ftx
+        # out_ft.shape == [batch_size, out_dim, n_modes, grid_size]
+
+        if self.mode_energy is not None:
+            energy = out_ft.abs().pow(2).sum(dim=(0, 1, 3)).detach()
+            self.mode_energy[1] = self.mode_energy[1] + energy
 
         xx = torch.fft.irfft(out_ft, n=M, dim=-2, norm='ortho')
-        # x.shape == [batch_size, in_dim, grid_size, grid_size]
+        # xx.shape == [batch_size, out_dim, grid_size, grid_size]
 
         # # Combining Dimensions # #
-        x = xx + xy
+        return xx + xy
 
-        x = rearrange(x, 'b i m n -> b m n i')
-        # x.shape == [batch_size, grid_size, grid_size, out_dim]
+    def mix_axes_fused(self, x):
+        # On a square grid, transforming along x is the same as transforming
+        # the transposed input along y. Stacking the input with its transpose
+        # lets both axes share a single rfft, contraction and irfft call.
+        B, I, M, N = x.shape
 
-        return x
+        x = torch.stack([x, x.transpose(-1, -2)])
+        # x.shape == [2, batch_size, in_dim, grid_size, grid_size]
+
+        n_modes = self.n_active_modes[0]
+        x_ft = torch.fft.rfft(x, dim=-1, norm='ortho')
+        x_ft = x_ft[..., :n_modes]
+        # x_ft.shape == [2, batch_size, in_dim, grid_size, n_modes]
+
+        if self.mode == 'full':
+            weight = torch.stack([w[..., :n_modes, :]
+                                  for w in self.fourier_weight], dim=2)
+            # weight.shape == [in_dim, out_dim, 2, n_modes, 2]
+
+            # The stacking dimension is treated as one more mode dimension.
+            out_ft = contract_modes(x_ft.permute(1, 2, 0, 3, 4),
+                                    torch.view_as_complex(weight),
+                                    dims=(2, 4), backend=self.spectral_backend)
+            out_ft = out_ft.permute(2, 0, 1, 3, 4)
+        elif self.mode == 'low-pass':
+            out_ft = x_ft
+        # out_ft.shape == [2, batch_size, out_dim, grid_size, n_modes]
+
+        out = torch.fft.irfft(out_ft, n=N, dim=-1, norm='ortho')
+        # out.shape == [2, batch_size, out_dim, grid_size, grid_size]
+
+        xy, xx = out.unbind(0)
+        return xx.transpose(-1, -2) + xy
 
 
 class FNOFactorized2DBlock(nn.Module):
     def __init__(self, modes, width, input_dim=12, dropout=0.0, in_dropout=0.0,
                  n_layers=4, linear_out: bool = False, share_weight: bool = False,
                  avg_outs=False, next_input='subtract', share_fork=False, factor=2,
-                 norm_locs=[], group_width=16, ff_weight_norm=False, n_ff_layers=2,
-                 gain=1, layer_norm=False, use_fork=False, mode='full'):
+                 norm_locs=[], group_width=None, ff_weight_norm=False, n_ff_layers=2,
+                 gain=1, layer_norm=False, use_fork=False, mode='full',
+                 channels_first=False, fuse_axes=False,
+                 spectral_backend='einsum', checkpoint_segment_size=0,
+                 weight_factorization=None, weight_rank=16,
+                 defer_forecast_head=False, spectral_stream=False,
+                 recompute_spectra=False, n_frames=1):
         super().__init__()
         self.modes = modes
         self.width = width
         self.input_dim = input_dim
-        self.in_proj = WNLinear(input_dim, self.width, wnorm=ff_weight_norm)
+        # When channels_first is enabled, the hidden state is kept as
+        # [batch_size, width, grid_size, grid_size] throughout the block, so
+        # the spectral layers don't need to transpose their inputs.
+        self.channels_first = channels_first
+        self.in_proj = WNLinear(input_dim, self.width, wnorm=ff_weight_norm,
+                                channels_first=channels_first)
         self.drop = nn.Dropout(in_dropout)
         self.next_input = next_input
         self.avg_outs = avg_outs
         self.n_layers = n_layers
         self.norm_locs = norm_locs
         self.use_fork = use_fork
+        # The number of future frames predicted by each forward pass.
+        self.n_frames = n_frames
+        self.checkpoint_segment_size = checkpoint_segment_size
+        # The output head is affine, so summing its outputs over all forks is
+        # the same as applying it once to the mean fork scaled by n_layers.
+        # With defer_forecast_head, the head is run once per step instead of
+        # once per layer, and forecast_list is only filled on request.
+        self.defer_forecast_head = defer_forecast_head
+        # With spectral_stream, the first layer gets its input spectra from
+        # the raw inputs, which have far fewer channels than the hidden state.
+        self.spectral_stream = spectral_stream
 
         self.forecast_ff = self.backcast_ff = None
         if share_fork:
             if use_fork:
                 self.forecast_ff = FeedForward(
-                    width, factor, ff_weight_norm, n_ff_layers, layer_norm, dropout)
+                    width, factor, ff_weight_norm, n_ff_layers, layer_norm,
+                    dropout, channels_first)
             self.backcast_ff = FeedForward(
-                width, factor, ff_weight_norm, n_ff_layers, layer_norm, dropout)
+                width, factor, ff_weight_norm, n_ff_layers, layer_norm,
+                dropout, channels_first)
 
         self.fourier_weight = None
-        if share_weight:
-            self.fourier_weight = nn.ParameterList([])
-            for _ in range(2):
-                weight = torch.FloatTensor(width, width, modes, 2)
-                param = nn.Parameter(weight)
-                nn.init.xavier_normal_(param, gain=gain)
-                self.fourier_weight.append(param)
+        if share_weight and weight_factorization:
+            self.fourier_weight = nn.ModuleList([
+                FactorizedSpectralWeight(width, width, (modes,),
+                                         weight_factorization, weight_rank,
+                                         gain=gain)
+                for _ in range(2)])
+        elif share_weight:
+            self.fourier_weight = nn.ParameterList([
+                new_fourier_weight(width, width, (modes,), group_width, gain)
+                for _ in range(2)])
 
         self.spectral_layers = nn.ModuleList([])
         for _ in range(n_layers):
@@ -172,38 +370,139 @@ class FNOFactorized2DBlock(nn.Module):
                                                        layer_norm=layer_norm,
                                                        use_fork=use_fork,
                                                        dropout=dropout,
-                                                       mode=mode))
+                                                       mode=mode,
+                                                       channels_first=channels_first,
+                                                       fuse_axes=fuse_axes,
+                                                       spectral_backend=spectral_backend,
+                                                       weight_factorization=weight_factorization,
+                                                       weight_rank=weight_rank,
+                                                       recompute_spectra=recompute_spectra))
 
         self.out = nn.Sequential(
-            WNLinear(self.width, 128, wnorm=ff_weight_norm),
-            WNLinear(128, 1, wnorm=ff_weight_norm))
+            WNLinear(self.width, 128, wnorm=ff_weight_norm,
+                     channels_first=channels_first),
+            WNLinear(128, n_frames, wnorm=ff_weight_norm,
+                     channels_first=channels_first))
 
-    def forward(self, x, **kwargs):
+    def forward(self, x, return_forecast_list=False, is_latent=False,
+                output_size=None, **kwargs):
         # x.shape == [n_batches, *dim_sizes, input_size]
+        # or [n_batches, *dim_sizes, width] if is_latent, in which case x is
+        # used as the output of in_proj. If output_size is given, e.g. when x
+        # is on a coarser grid, the forecasts are resampled to that size.
         forecast = 0
-        x = self.in_proj(x)
-        x = self.drop(x)
+        if self.channels_first:
+            # The raw inputs have far fewer channels than the hidden state, so
+            # this is the cheapest place to change the layout.
+            x = rearrange(x, 'b m n i -> b i m n')
+        x_ft = None
+        if not is_latent:
+            inputs = x
+            x = self.in_proj(x)
+            x = self.drop(x)
+            if self.spectral_stream and \
+                    not (self.training and self.drop.p > 0):
+                x_ft = self._project_spectra(inputs)
         forecast_list = []
-        for i in range(self.n_layers):
-            layer = self.spectral_layers[i]
-            b, f = layer(x)
-
-            if self.use_fork:
-                f_out = self.out(f)
-                forecast = forecast + f_out
-                forecast_list.append(f_out)
-
-            if self.next_input == 'subtract':
-                x = x - b
-            elif self.next_input == 'add':
-                x = x + b
-
-        if not self.use_fork:
+        f_sum = 0
+        defer = self.use_fork and self.defer_forecast_head
+        keep_forecasts = not self.defer_forecast_head or return_forecast_list
+        # With checkpointing, only the input of each segment of layers is kept
+        # for the backward pass; the rest is recomputed.
+        size = self.checkpoint_segment_size or self.n_layers
+        use_checkpoint = self.checkpoint_segment_size > 0 and \
+            torch.is_grad_enabled()
+        for start in range(0, self.n_layers, size):
+            end = min(start + size, self.n_layers)
+            if use_checkpoint:
+                outputs = list(checkpoint(self._forward_segment, x, start, end,
+                                          keep_forecasts, *(x_ft or ())))
+                x, b = outputs[:2]
+                segment_sum = outputs.pop(2) if defer else 0
+                f_outs = list(outputs[2]) if len(outputs) > 2 else []
+            else:
+                x, b, segment_sum, f_outs = self._forward_layers(
+                    x, start, end, keep_forecasts, x_ft)
+            # Only the input of the first layer has known spectra.
+            x_ft = None
+
+            f_sum = f_sum + segment_sum
+            if not defer:
+                for f_out in f_outs:
+                    forecast = forecast + f_out
+            forecast_list.extend(f_outs)
+
+        if defer:
+            forecast = self.out(f_sum / self.n_layers) * self.n_layers
+        elif not self.use_fork:
             forecast = self.out(b)
         if self.avg_outs:
             forecast = forecast / len(self.spectral_layers)
 
+        if self.channels_first:
+            forecast = rearrange(forecast, 'b i m n -> b m n i')
+            forecast_list = [rearrange(f_out, 'b i m n -> b m n i')
+                             for f_out in forecast_list]
+
+        if output_size is not None:
+            forecast = resample_grid(forecast, output_size)
+            forecast_list = [resample_grid(f_out, output_size)
+                             for f_out in forecast_list]
+
         return {
             'forecast': forecast,
             'forecast_list': forecast_list,
         }
+
+    def _project_spectra(self, x):
+        # x.shape == [batch_size, input_dim, grid_size, grid_size]
+        # or [batch_size, grid_size, grid_size, input_dim]
+        if not self.channels_first:
+            x = rearrange(x, 'b m n i -> b i m n')
+        M, N = x.shape[-2:]
+
+        # in_proj is affine, so the spectra of its outputs are the projected
+        # spectra of its inputs. The bias is constant over the grid and only
+        # shows up in the zeroth mode, scaled by sqrt(n) under ortho norm.
+        with torch.autocast(x.device.type, enabled=False):
+            x_fty, x_ftx = truncated_spectra(x.float(), self.modes)
+            weight = self.in_proj.weight.float().to(x_fty.dtype)
+            x_fty = torch.einsum('bixy,oi->boxy', x_fty, weight)
+            x_ftx = torch.einsum('bixy,oi->boxy', x_ftx, weight)
+            if self.in_proj.bias is not None:
+                bias = self.in_proj.bias.float()[:, None]
+                x_fty[..., 0] = x_fty[..., 0] + bias * math.sqrt(N)
+                x_ftx[..., 0, :] = x_ftx[..., 0, :] + bias * math.sqrt(M)
+        # x_fty.shape == [batch_size, width, grid_size, n_modes]
+        # x_ftx.shape == [batch_size, width, n_modes, grid_size]
+
+        return x_fty, x_ftx
+
+    def _forward_layers(self, x, start, end, keep_forecasts=True, x_ft=None):
+        f_sum, f_outs = 0, []
+        for i, layer in enumerate(self.spectral_layers[start:end]):
+            b, f = layer(x, x_ft if i == 0 else None)
+
+            if self.use_fork and self.defer_forecast_head:
+                f_sum = f_sum + f
+            if self.use_fork and keep_forecasts:
+                f_outs.append(self.out(f))
+
+            if self.next_input == 'subtract':
+                x = x - b
+            elif self.next_input == 'add':
+                x = x + b
+
+        return x, b, f_sum, f_outs
+
+    def _forward_segment(self, x, start, end, keep_forecasts=True, *x_ft):
+        # checkpoint() only passes tensors through, so the forecasts of the
+        # segment are stacked into a single tensor.
+        x, b, f_sum, f_outs = self._forward_layers(
+            x, start, end, keep_forecasts, x_ft or None)
+        outputs = [x, b]
+        if self.use_fork and self.defer_forecast_head:
+            outputs.append(f_sum)
+        if f_outs:
+            outputs.append(torch.stack(f_outs))
+        return tuple(outputs)
@@ -0,0 +1,160 @@
+import torch
+import torch.nn as nn
+from einops import rearrange
+
+from .fno_factorized_2d import FeedForward
+from .linear import WNLinear
+from .spectral import contract_modes, full_precision, new_fourier_weight
+
+
+class SpectralConv3d(nn.Module):
+    def __init__(self, in_dim, out_dim, n_modes, forecast_ff, backcast_ff,
+                 fourier_weight, factor, ff_weight_norm, n_ff_layers,
+                 layer_norm, use_fork, dropout, mode,
+                 spectral_backend='einsum'):
+        super().__init__()
+        self.in_dim = in_dim
+        self.out_dim = out_dim
+        self.n_modes = n_modes
+        self.mode = mode
+        self.use_fork = use_fork
+        self.spectral_backend = spectral_backend
+
+        # One set of weights per axis, so the number of weights grows linearly
+        # with n_modes rather than with n_modes^3 as in a full 3D FNO.
+        self.fourier_weight = fourier_weight
+        if not self.fourier_weight:
+            self.fourier_weight = nn.ParameterList([
+                new_fourier_weight(in_dim, out_dim, (n_modes,))
+                for _ in range(3)])
+
+        if use_fork:
+            self.forecast_ff = forecast_ff
+            if not self.forecast_ff:
+                self.forecast_ff = FeedForward(
+                    out_dim, factor, ff_weight_norm, n_ff_layers, layer_norm,
+                    dropout)
+
+        self.backcast_ff = backcast_ff
+        if not self.backcast_ff:
+            self.backcast_ff = FeedForward(
+                out_dim, factor, ff_weight_norm, n_ff_layers, layer_norm,
+                dropout)
+
+    def forward(self, x):
+        # x.shape == [batch_size, grid_size, grid_size, grid_size, in_dim]
+        if self.mode != 'no-fourier':
+            x = full_precision(self.forward_fourier, x)
+
+        b = self.backcast_ff(x)
+        f = self.forecast_ff(x) if self.use_fork else None
+        return b, f
+
+    def forward_fourier(self, x):
+        x = rearrange(x, 'b m n l i -> b i m n l')
+        # x.shape == [batch_size, in_dim, grid_size, grid_size, grid_size]
+
+        out = 0
+        for i, dim in enumerate([2, 3, 4]):
+            size = x.shape[dim]
+
+            x_ft = torch.fft.rfft(x, dim=dim, norm='ortho')
+            x_ft = x_ft.narrow(dim, 0, self.n_modes)
+            # x_ft.shape == [batch_size, in_dim, ..., n_modes, ...]
+
+            if self.mode == 'full':
+                weight = torch.view_as_complex(self.fourier_weight[i])
+                x_ft = contract_modes(x_ft, weight, dims=(dim,),
+                                      backend=self.spectral_backend)
+            # x_ft.shape == [batch_size, out_dim, ..., n_modes, ...]
+
+            # irfft zero-pads the truncated spectrum back up to size.
+            out = out + torch.fft.irfft(x_ft, n=size, dim=dim, norm='ortho')
+        # out.shape == [batch_size, out_dim, grid_size, grid_size, grid_size]
+
+        return rearrange(out, 'b i m n l -> b m n l i')
+
+
+class FNOFactorized3DBlock(nn.Module):
+    def __init__(self, modes, width, input_dim=4, dropout=0.0, in_dropout=0.0,
+                 n_layers=4, share_weight: bool = False, avg_outs=False,
+                 next_input='subtract', share_fork=False, factor=2,
+                 ff_weight_norm=False, n_ff_layers=2, gain=1,
+                 layer_norm=False, use_fork=False, mode='full',
+                 spectral_backend='einsum'):
+        super().__init__()
+        self.modes = modes
+        self.width = width
+        self.input_dim = input_dim
+        self.in_proj = WNLinear(input_dim, self.width, wnorm=ff_weight_norm)
+        self.drop = nn.Dropout(in_dropout)
+        self.next_input = next_input
+        self.avg_outs = avg_outs
+        self.n_layers = n_layers
+        self.use_fork = use_fork
+
+        self.forecast_ff = self.backcast_ff = None
+        if share_fork:
+            if use_fork:
+                self.forecast_ff = FeedForward(
+                    width, factor, ff_weight_norm, n_ff_layers, layer_norm,
+                    dropout)
+            self.backcast_ff = FeedForward(
+                width, factor, ff_weight_norm, n_ff_layers, layer_norm,
+                dropout)
+
+        self.fourier_weight = None
+        if share_weight:
+            self.fourier_weight = nn.ParameterList([
+                new_fourier_weight(width, width, (modes,), gain=gain)
+                for _ in range(3)])
+
+        self.spectral_layers = nn.ModuleList([])
+        for _ in range(n_layers):
+            self.spectral_layers.append(SpectralConv3d(in_dim=width,
+                                                       out_dim=width,
+                                                       n_modes=modes,
+                                                       forecast_ff=self.forecast_ff,
+                                                       backcast_ff=self.backcast_ff,
+                                                       fourier_weight=self.fourier_weight,
+                                                       factor=factor,
+                                                       ff_weight_norm=ff_weight_norm,
+                                                       n_ff_layers=n_ff_layers,
+                                                       layer_norm=layer_norm,
+                                                       use_fork=use_fork,
+                                                       dropout=dropout,
+                                                       mode=mode,
+                                                       spectral_backend=spectral_backend))
+
+        self.out = nn.Sequential(
+            WNLinear(self.width, 128, wnorm=ff_weight_norm),
+            WNLinear(128, 1, wnorm=ff_weight_norm))
+
+    def forward(self, x, **kwargs):
+        # x.shape == [n_batches, *dim_sizes, input_size]
+        forecast = 0
+        x = self.in_proj(x)
+        x = self.drop(x)
+        forecast_list = []
+        for layer in self.spectral_layers:
+            b, f = layer(x)
+
+            if self.use_fork:
+                f_out = self.out(f)
+                forecast = forecast + f_out
+                forecast_list.append(f_out)
+
+            if self.next_input == 'subtract':
+                x = x - b
+            elif self.next_input == 'add':
+                x = x + b
+
+        if not self.use_fork:
+            forecast = self.out(b)
+        if self.avg_outs:
+            forecast = forecast / len(self.spectral_layers)
+
+        return {
+            'forecast': forecast,
+            'forecast_list': forecast_list,
+        }
@@ -2,8 +2,11 @@
 import torch
 import torch.nn as nn
 from einops import rearrange
+from torch.utils.checkpoint import checkpoint
 
 from .linear import WNLinear
+from .spectral import (FactorizedSpectralWeight, contract_groups,
+                       contract_modes, full_precision, new_fourier_weight)
 
 
 class FeedForward(nn.Module):
@@ -30,7 +33,9 @@ class FeedForward(nn.Module):
 class SpectralConv2d(nn.Module):
     def __init__(self, in_dim, out_dim, n_modes, forecast_ff, backcast_ff,
                  fourier_weight, factor, norm_locs, group_width, ff_weight_norm,
-                 n_ff_layers, layer_norm, use_fork, dropout, mode):
+                 n_ff_layers, layer_norm, use_fork, dropout, mode,
+                 spectral_backend='einsum', weight_factorization=None,
+                 weight_rank=16):
         super().__init__()
         self.in_dim = in_dim
         self.out_dim = out_dim
@@ -39,17 +44,24 @@ class SpectralConv2d(nn.Module):
         self.group_width = group_width
         self.mode = mode
         self.use_fork = use_fork
+        self.spectral_backend = spectral_backend
+
+        # Channels are only mixed within groups of group_width channels.
+        self.n_groups = in_dim // group_width if group_width else 1
+        if self.n_groups > 1 and weight_factorization:
+            raise ValueError('Grouped weights cannot also be factorized')
 
         self.fourier_weight = fourier_weight
+        if not self.fourier_weight and weight_factorization:
+            self.fourier_weight = nn.ModuleList([
+                FactorizedSpectralWeight(in_dim, out_dim, (n_modes, n_modes),
+                                         weight_factorization, weight_rank)
+                for _ in range(2)])
         # Can't use complex type yet. See https://github.com/pytorch/pytorch/issues/59998
-        if not self.fourier_weight:
-            self.fourier_weight = nn.ParameterList([])
-            for _ in range(2):
-                weight = torch.FloatTensor(
-                    in_dim, out_dim, n_modes, n_modes, 2)
-                param = nn.Parameter(weight)
-                nn.init.xavier_normal_(param)
-                self.fourier_weight.append(param)
+        elif not self.fourier_weight:
+            self.fourier_weight = nn.ParameterList([
+                new_fourier_weight(in_dim, out_dim, (n_modes, n_modes), group_width)
+                for _ in range(2)])
 
         if use_fork:
             self.forecast_ff = forecast_ff
@@ -65,12 +77,21 @@ class SpectralConv2d(nn.Module):
     def forward(self, x):
         # x.shape == [batch_size, grid_size, grid_size, in_dim]
         if self.mode != 'no-fourier':
-            x = self.forward_fourier(x)
+            x = full_precision(self.forward_fourier, x)
 
         b = self.backcast_ff(x)
         f = self.forecast_ff(x) if self.use_fork else None
         return b, f
 
+    def contract(self, x, i, dims):
+        weight = self.fourier_weight[i]
+        if isinstance(weight, FactorizedSpectralWeight):
+            return weight(x, dims, self.spectral_backend)
+        weight = torch.view_as_complex(weight)
+        if self.n_groups > 1:
+            return contract_groups(x, weight, dims, self.spectral_backend)
+        return contract_modes(x, weight, dims, self.spectral_backend)
+
     def forward_fourier(self, x):
         x = rearrange(x, 'b m n i -> b i m n')
         # x.shape == [batch_size, in_dim, grid_size, grid_size]
@@ -84,15 +105,11 @@ class SpectralConv2d(nn.Module):
         # out_ft.shape == [batch_size, in_dim, grid_size, grid_size // 2 + 1, 2]
 
         if self.mode == 'full':
-            out_ft[:, :, :self.n_modes, :self.n_modes] = torch.einsum(
-                "bixy,ioxy->boxy",
-                x_ft[:, :, :self.n_modes, :self.n_modes],
-                torch.view_as_complex(self.fourier_weight[0]))
-
-            out_ft[:, :, -self.n_modes:, :self.n_modes] = torch.einsum(
-                "bixy,ioxy->boxy",
-                x_ft[:, :, -self.n_modes:, :self.n_modes],
-                torch.view_as_complex(self.fourier_weight[1]))
+            out_ft[:, :, :self.n_modes, :self.n_modes] = self.contract(
+                x_ft[:, :, :self.n_modes, :self.n_modes], 0, dims=(2, 3))
+
+            out_ft[:, :, -self.n_modes:, :self.n_modes] = self.contract(
+                x_ft[:, :, -self.n_modes:, :self.n_modes], 1, dims=(2, 3))
         elif self.mode == 'low-pass':
             raise
 
@@ -109,8 +126,10 @@ class FNOPlus2DBlock(nn.Module):
     def __init__(self, modes, width, input_dim=12, dropout=0.0, in_dropout=0.0,
                  n_layers=4, linear_out: bool = False, share_weight: bool = False,
                  avg_outs=False, next_input='subtract', share_fork=False, factor=2,
-                 norm_locs=[], group_width=16, ff_weight_norm=False, n_ff_layers=2,
-                 gain=1, layer_norm=False, use_fork=False, mode='full'):
+                 norm_locs=[], group_width=None, ff_weight_norm=False, n_ff_layers=2,
+                 gain=1, layer_norm=False, use_fork=False, mode='full',
+                 spectral_backend='einsum', checkpoint_segment_size=0,
+                 weight_factorization=None, weight_rank=16):
         super().__init__()
         self.modes = modes
         self.width = width
@@ -122,6 +141,7 @@ class FNOPlus2DBlock(nn.Module):
         self.n_layers = n_layers
         self.norm_locs = norm_locs
         self.use_fork = use_fork
+        self.checkpoint_segment_size = checkpoint_segment_size
 
         self.forecast_ff = self.backcast_ff = None
         if share_fork:
@@ -132,13 +152,16 @@ class FNOPlus2DBlock(nn.Module):
                 width, factor, ff_weight_norm, n_ff_layers, layer_norm, dropout)
 
         self.fourier_weight = None
-        if share_weight:
-            self.fourier_weight = nn.ParameterList([])
-            for _ in range(2):
-                weight = torch.FloatTensor(width, width, modes, modes, 2)
-                param = nn.Parameter(weight)
-                nn.init.xavier_normal_(param, gain=gain)
-                self.fourier_weight.append(param)
+        if share_weight and weight_factorization:
+            self.fourier_weight = nn.ModuleList([
+                FactorizedSpectralWeight(width, width, (modes, modes),
+                                         weight_factorization, weight_rank,
+                                         gain=gain)
+                for _ in range(2)])
+        elif share_weight:
+            self.fourier_weight = nn.ParameterList([
+                new_fourier_weight(width, width, (modes, modes), group_width, gain)
+                for _ in range(2)])
 
         self.spectral_layers = nn.ModuleList([])
         for _ in range(n_layers):
@@ -156,7 +179,10 @@ class FNOPlus2DBlock(nn.Module):
                                                        layer_norm=layer_norm,
                                                        use_fork=use_fork,
                                                        dropout=dropout,
-                                                       mode=mode))
+                                                       mode=mode,
+                                                       spectral_backend=spectral_backend,
+                                                       weight_factorization=weight_factorization,
+                                                       weight_rank=weight_rank))
 
         self.out = nn.Sequential(
             WNLinear(self.width, 128, wnorm=ff_weight_norm),
@@ -168,19 +194,23 @@ class FNOPlus2DBlock(nn.Module):
         x = self.in_proj(x)
         x = self.drop(x)
         forecast_list = []
-        for i in range(self.n_layers):
-            layer = self.spectral_layers[i]
-            b, f = layer(x)
-
-            if self.use_fork:
-                f_out = self.out(f)
+        # With checkpointing, only the input of each segment of layers is kept
+        # for the backward pass; the rest is recomputed.
+        size = self.checkpoint_segment_size or self.n_layers
+        use_checkpoint = self.checkpoint_segment_size > 0 and \
+            torch.is_grad_enabled()
+        for start in range(0, self.n_layers, size):
+            end = min(start + size, self.n_layers)
+            if use_checkpoint:
+                outputs = checkpoint(self._forward_segment, x, start, end)
+                x, b = outputs[:2]
+                f_outs = list(outputs[2]) if self.use_fork else []
+            else:
+                x, b, f_outs = self._forward_layers(x, start, end)
+
+            for f_out in f_outs:
                 forecast = forecast + f_out
-                forecast_list.append(f_out)
-
-            if self.next_input == 'subtract':
-                x = x - b
-            elif self.next_input == 'add':
-                x = x + b
+            forecast_list.extend(f_outs)
 
         if not self.use_fork:
             forecast = self.out(b)
@@ -191,3 +221,26 @@ class FNOPlus2DBlock(nn.Module):
             'forecast': forecast,
             'forecast_list': forecast_list,
         }
+
+    def _forward_layers(self, x, start, end):
+        f_outs = []
+        for layer in self.spectral_layers[start:end]:
+            b, f = layer(x)
+
+            if self.use_fork:
+                f_outs.append(self.out(f))
+
+            if self.next_input == 'subtract':
+                x = x - b
+            elif self.next_input == 'add':
+                x = x + b
+
+        return x, b, f_outs
+
+    def _forward_segment(self, x, start, end):
+        # checkpoint() only passes tensors through, so the forecasts of the
+        # segment are stacked into a single tensor.
+        x, b, f_outs = self._forward_layers(x, start, end)
+        if self.use_fork:
+            return x, b, torch.stack(f_outs)
+        return x, b
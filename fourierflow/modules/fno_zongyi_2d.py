@@ -6,15 +6,16 @@ to propagates in time.
 """
 
 
-from functools import partial
-
 import torch
 import torch.nn as nn
 from einops import rearrange
 
+from .spectral import contract_modes, full_precision
+
 
 class SpectralConv2d(nn.Module):
-    def __init__(self, in_dim, out_dim, n_modes, resdiual=True, dropout=0.1):
+    def __init__(self, in_dim, out_dim, n_modes, resdiual=True, dropout=0.1,
+                 spectral_backend='einsum'):
         super().__init__()
         self.in_dim = in_dim
         self.out_dim = out_dim
@@ -22,6 +23,7 @@ class SpectralConv2d(nn.Module):
         self.linear = nn.Linear(in_dim, out_dim)
         self.residual = resdiual
         self.act = nn.ReLU(inplace=True)
+        self.spectral_backend = spectral_backend
 
         fourier_weight = [nn.Parameter(torch.FloatTensor(
             in_dim, out_dim, n_modes, n_modes, 2)) for _ in range(2)]
@@ -29,40 +31,38 @@ class SpectralConv2d(nn.Module):
         for param in self.fourier_weight:
             nn.init.xavier_normal_(param, gain=1/(in_dim*out_dim))
 
-    @staticmethod
-    def complex_matmul_2d(a, b):
-        # (batch, in_channel, x, y), (in_channel, out_channel, x, y) -> (batch, out_channel, x, y)
-        op = partial(torch.einsum, "bixy,ioxy->boxy")
-        return torch.stack([
-            op(a[..., 0], b[..., 0]) - op(a[..., 1], b[..., 1]),
-            op(a[..., 1], b[..., 0]) + op(a[..., 0], b[..., 1])
-        ], dim=-1)
-
     def forward(self, x):
         # x.shape == [batch_size, grid_size, grid_size, in_dim]
-        B, M, N, I = x.shape
         res = self.linear(x)
         # res.shape == [batch_size, grid_size, grid_size, out_dim]
 
+        x = full_precision(self.forward_fourier, x).to(res.dtype)
+
+        if self.residual:
+            x = self.act(x + res)
+        return x
+
+    def forward_fourier(self, x):
+        B, M, N, I = x.shape
+
         x = rearrange(x, 'b m n i -> b i m n')
         # x.shape == [batch_size, in_dim, grid_size, grid_size]
 
         x_ft = torch.fft.rfft2(x, s=(M, N), norm='ortho')
         # x_ft.shape == [batch_size, in_dim, grid_size, grid_size // 2 + 1]
 
-        x_ft = torch.stack([x_ft.real, x_ft.imag], dim=4)
-        # x_ft.shape == [batch_size, in_dim, grid_size, grid_size // 2 + 1, 2]
-
-        out_ft = torch.zeros(B, I, N, M // 2 + 1, 2, device=x.device)
-        # out_ft.shape == [batch_size, in_dim, grid_size, grid_size // 2 + 1, 2]
+        out_ft = x_ft.new_zeros(B, I, N, M // 2 + 1)
+        # out_ft.shape == [batch_size, in_dim, grid_size, grid_size // 2 + 1]
 
-        out_ft[:, :, :self.n_modes, :self.n_modes] = self.complex_matmul_2d(
-            x_ft[:, :, :self.n_modes, :self.n_modes], self.fourier_weight[0])
+        out_ft[:, :, :self.n_modes, :self.n_modes] = contract_modes(
+            x_ft[:, :, :self.n_modes, :self.n_modes],
+            torch.view_as_complex(self.fourier_weight[0]),
+            dims=(2, 3), backend=self.spectral_backend)
 
-        out_ft[:, :, -self.n_modes:, :self.n_modes] = self.complex_matmul_2d(
-            x_ft[:, :, -self.n_modes:, :self.n_modes], self.fourier_weight[1])
-
-        out_ft = torch.complex(out_ft[..., 0], out_ft[..., 1])
+        out_ft[:, :, -self.n_modes:, :self.n_modes] = contract_modes(
+            x_ft[:, :, -self.n_modes:, :self.n_modes],
+            torch.view_as_complex(self.fourier_weight[1]),
+            dims=(2, 3), backend=self.spectral_backend)
 
         x = torch.fft.irfft2(out_ft, s=(N, M), norm='ortho')
         # x.shape == [batch_size, in_dim, grid_size, grid_size]
@@ -70,13 +70,12 @@ class SpectralConv2d(nn.Module):
         x = rearrange(x, 'b i m n -> b m n i')
         # x.shape == [batch_size, grid_size, grid_size, out_dim]
 
-        if self.residual:
-            x = self.act(x + res)
         return x
 
 
 class FNOZongyi2DBlock(nn.Module):
-    def __init__(self, modes1, modes2, width, input_dim=12, dropout=0.1, n_layers=4, residual=False, conv_residual=True):
+    def __init__(self, modes1, modes2, width, input_dim=12, dropout=0.1, n_layers=4, residual=False, conv_residual=True,
+                 spectral_backend='einsum'):
         super().__init__()
 
         """
@@ -106,7 +105,8 @@ class FNOZongyi2DBlock(nn.Module):
                                                        out_dim=width,
                                                        n_modes=modes1,
                                                        resdiual=conv_residual,
-                                                       dropout=dropout))
+                                                       dropout=dropout,
+                                                       spectral_backend=spectral_backend))
 
         self.feedforward = nn.Sequential(
             nn.Linear(self.width, 128),
@@ -2,8 +2,10 @@ import copy
 import logging
 import math
 
+import torch
 import torch.nn as nn
-from torch.nn.utils import weight_norm
+import torch.nn.functional as F
+from torch.nn.utils import remove_weight_norm, weight_norm
 from torch.nn.utils.weight_norm import WeightNorm
 
 logger = logging.getLogger(__name__)
@@ -39,17 +41,31 @@ class GehringLinear(nn.Linear):
 
 
 class WNLinear(nn.Linear):
-    def __init__(self, in_features: int, out_features: int, bias: bool = True, device=None, dtype=None, wnorm=False):
+    def __init__(self, in_features: int, out_features: int, bias: bool = True, device=None, dtype=None, wnorm=False, channels_first=False):
         super().__init__(in_features=in_features,
                          out_features=out_features,
                          bias=bias,
                          device=device,
                          dtype=dtype)
+        self.channels_first = channels_first
         if wnorm:
             weight_norm(self)
 
         self._fix_weight_norm_deepcopy()
 
+    def forward(self, x):
+        if not self.channels_first:
+            return super().forward(x)
+
+        # x.shape == [batch_size, in_features, *dim_sizes]
+        # A pointwise linear layer is a 1x1 convolution when the channels come
+        # first. The weight keeps the same shape so checkpoints are shared
+        # between the two layouts.
+        n_dims = x.ndim - 2
+        weight = self.weight.view(*self.weight.shape, *([1] * n_dims))
+        conv = [F.conv1d, F.conv2d, F.conv3d][n_dims - 1]
+        return conv(x, weight, self.bias)
+
     def _fix_weight_norm_deepcopy(self):
         # Fix bug where deepcopy doesn't work with weightnorm.
         # Taken from https://github.com/pytorch/pytorch/issues/28594#issuecomment-679534348
@@ -77,3 +93,48 @@ class WNLinear(nn.Linear):
             return result
         # bind __deepcopy__ to the weightnorm'd layer
         self.__deepcopy__ = __deepcopy__.__get__(self, self.__class__)
+
+
+def fold_weight_norm(module):
+    """Replace weight-normed linear layers with their static weights.
+
+    This saves recomputing g * v / ||v|| on every call, which adds up when the
+    same feedforward is shared across all layers.
+    """
+    for m in module.modules():
+        hooks = [h for h in m._forward_pre_hooks.values()
+                 if isinstance(h, WeightNorm)]
+        for hook in hooks:
+            remove_weight_norm(m, hook.name)
+    return module
+
+
+def to_plain_linear(module):
+    """Swap channels-last WNLinear layers for nn.Linear with the same weights.
+
+    Tools like dynamic quantization match layers by their exact type and would
+    skip the subclass. Weight norm must be folded first.
+    """
+    for name, child in module.named_children():
+        if isinstance(child, WNLinear) and not child.channels_first:
+            linear = nn.Linear(child.in_features, child.out_features,
+                               bias=child.bias is not None)
+            linear.load_state_dict(child.state_dict())
+            setattr(module, name, linear)
+        else:
+            to_plain_linear(child)
+    return module
+
+
+@torch.no_grad()
+def fold_input_affine(linear, shift, scale):
+    """Absorb x -> (x - shift) / scale into the input of a linear layer."""
+    linear.bias.sub_(linear.weight @ (shift / scale))
+    linear.weight.div_(scale)
+
+
+@torch.no_grad()
+def fold_output_affine(linear, shift, scale):
+    """Absorb y -> y * scale + shift into the output of a linear layer."""
+    linear.weight.mul_(scale.unsqueeze(-1))
+    linear.bias.mul_(scale).add_(shift)
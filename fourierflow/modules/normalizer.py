@@ -39,6 +39,9 @@ class Normalizer(nn.Module):
         elif len(self.dim_sizes) == 2:
             m, n = self.dim_sizes
             x = rearrange(x, '(b m n) h -> b m n h', m=m, n=n)
+        elif len(self.dim_sizes) == 3:
+            m, n, l = self.dim_sizes
+            x = rearrange(x, '(b m n l) h -> b m n l h', m=m, n=n, l=l)
         return x
 
     def forward(self, x):
@@ -0,0 +1,277 @@
+import math
+import string
+
+import torch
+import torch.nn as nn
+
+BACKENDS = ['einsum', 'bmm']
+
+
+def contract_modes(x, weight, dims, backend='einsum'):
+    """Mix the channels of a spectrum independently at each Fourier mode.
+
+    Parameters
+    ----------
+    x : torch.Tensor
+        Complex spectrum of shape [batch_size, in_dim, *dim_sizes].
+
+    weight : torch.Tensor
+        Complex weights of shape [in_dim, out_dim, *n_modes].
+
+    dims : tuple of int
+        The dimensions of x that the mode dimensions of the weight line up
+        with. The remaining spatial dimensions of x share the same weights.
+
+    backend : str
+        Either 'einsum', or 'bmm' to run a single batched matrix multiply with
+        the modes as the batch dimension.
+
+    Returns
+    -------
+    torch.Tensor
+        Complex spectrum of shape [batch_size, out_dim, *dim_sizes].
+
+    """
+    if backend == 'einsum':
+        return _contract_einsum(x, weight, dims)
+    elif backend == 'bmm':
+        return _contract_bmm(x, weight, dims)
+    raise ValueError(f'Unknown spectral backend: {backend}')
+
+
+def _contract_einsum(x, weight, dims):
+    letters = string.ascii_lowercase[-(x.ndim - 2):]
+    x_subs = 'bi' + letters
+    w_subs = 'io' + ''.join(letters[d - 2] for d in dims)
+    out_subs = 'bo' + letters
+    return torch.einsum(f'{x_subs},{w_subs}->{out_subs}', x, weight)
+
+
+def _contract_bmm(x, weight, dims):
+    B, I = x.shape[:2]
+    O = weight.shape[1]
+    other = [d for d in range(2, x.ndim) if d not in dims]
+
+    # Move the mode dimensions to the front so they become the batch
+    # dimension of bmm, and fold everything else into the rows.
+    x = x.permute(*dims, 0, *other, 1)
+    # x.shape == [*n_modes, batch_size, *other_sizes, in_dim]
+
+    perm_shape = x.shape
+    n_modes = perm_shape[:len(dims)]
+    x = x.reshape(n_modes.numel(), -1, I)
+    # x.shape == [prod(n_modes), batch_size * prod(other_sizes), in_dim]
+
+    w = weight.permute(*range(2, weight.ndim), 0, 1)
+    w = w.reshape(n_modes.numel(), I, O)
+    # w.shape == [prod(n_modes), in_dim, out_dim]
+
+    out = torch.bmm(x, w)
+    out = out.reshape(*perm_shape[:-1], O)
+    # out.shape == [*n_modes, batch_size, *other_sizes, out_dim]
+
+    # Invert the permutation applied to x.
+    order = [*dims, 0, *other, 1]
+    inverse = [order.index(d) for d in range(len(order))]
+    return out.permute(*inverse)
+
+
+def contract_groups(x, weight, dims, backend='einsum'):
+    """Like contract_modes, but channels are only mixed within their group.
+
+    The weight has shape [n_groups, group_in_dim, group_out_dim, *n_modes], so
+    the cost per mode is in_dim * group_out_dim rather than in_dim * out_dim.
+    """
+    B, I = x.shape[:2]
+    G, _, O = weight.shape[:3]
+
+    x = x.reshape(B, G, I // G, *x.shape[2:]).transpose(1, 2)
+    # x.shape == [batch_size, group_in_dim, n_groups, *dim_sizes]
+
+    # The group dimension is treated as one more mode dimension.
+    weight = weight.movedim(0, 2)
+    dims = (2, *[d + 1 for d in dims])
+    out = contract_modes(x, weight, dims, backend)
+    # out.shape == [batch_size, group_out_dim, n_groups, *dim_sizes]
+
+    return out.transpose(1, 2).reshape(B, G * O, *out.shape[3:])
+
+
+def full_precision(fn, x, *args):
+    """Return fn(x, *args) with x in float32 and autocast disabled.
+
+    FFTs and mode contractions always run in full precision, even when the
+    rest of the block is under a bf16 autocast.
+    """
+    with torch.autocast(x.device.type, enabled=False):
+        return fn(x.float(), *args)
+
+
+def resample_grid(x, size):
+    """Resample periodic fields to a new grid size in Fourier space.
+
+    x has shape [batch_size, grid_size, grid_size, n_channels]. Frequencies
+    that the smaller of the two grids can't hold are dropped, including its
+    Nyquist frequencies, and the rest are zero-padded. With norm='forward',
+    the values keep their scale.
+    """
+    B, M, N, C = x.shape
+    m, n = size
+    if (M, N) == (m, n):
+        return x
+
+    with torch.autocast(x.device.type, enabled=False):
+        x_ft = torch.fft.rfft2(x.float(), dim=(1, 2), norm='forward')
+        # x_ft.shape == [batch_size, grid_size, grid_size // 2 + 1, n_channels]
+
+        k_m, k_n = min(M, m) // 2, min(N, n) // 2
+        out_ft = x_ft.new_zeros(B, m, n // 2 + 1, C)
+        out_ft[:, :k_m, :k_n] = x_ft[:, :k_m, :k_n]
+        # The negative frequencies stop short of the Nyquist row, just like
+        # the columns, so that the spectrum stays Hermitian.
+        out_ft[:, m - k_m + 1:, :k_n] = x_ft[:, M - k_m + 1:, :k_n]
+
+        return torch.fft.irfft2(out_ft, s=(m, n), dim=(1, 2), norm='forward')
+
+
+class RecomputeSpectra(torch.autograd.Function):
+    """Run fn(x) without keeping its intermediate spectra for backward.
+
+    Only x is saved. The backward pass runs fn again with grad enabled and
+    backpropagates through that, so the complex spectra of the forward pass
+    are freed as soon as it returns. The params are the tensors that fn reads
+    directly, such as the spectral weights, and get their gradients this way.
+    """
+
+    @staticmethod
+    def forward(ctx, fn, x, *params):
+        ctx.fn = fn
+        ctx.params = params
+        ctx.save_for_backward(x)
+        with torch.no_grad():
+            return fn(x)
+
+    @staticmethod
+    def backward(ctx, grad):
+        x, = ctx.saved_tensors
+        x = x.detach().requires_grad_(ctx.needs_input_grad[1])
+        with torch.enable_grad():
+            out = ctx.fn(x)
+
+        inputs = [x, *ctx.params]
+        needs_grad = ctx.needs_input_grad[1:]
+        wanted = [t for t, n in zip(inputs, needs_grad) if n]
+        grads = iter(torch.autograd.grad(out, wanted, grad, allow_unused=True))
+        return (None, *[next(grads) if n else None for n in needs_grad])
+
+
+def new_fourier_weight(in_dim, out_dim, n_modes, group_width=None, gain=1):
+    """Create real-valued spectral weights with a trailing (real, imag) dim.
+
+    Without groups, the shape is [in_dim, out_dim, *n_modes, 2]. With groups of
+    group_width channels, it is [n_groups, group_width, out_dim // n_groups,
+    *n_modes, 2], and each group is initialized like a dense weight.
+    """
+    if not group_width or group_width == in_dim:
+        param = nn.Parameter(torch.FloatTensor(in_dim, out_dim, *n_modes, 2))
+        nn.init.xavier_normal_(param, gain=gain)
+        return param
+
+    if in_dim % group_width or out_dim % (in_dim // group_width):
+        raise ValueError(f'Cannot split {in_dim} -> {out_dim} channels into '
+                         f'groups of width {group_width}')
+    n_groups = in_dim // group_width
+    param = nn.Parameter(torch.FloatTensor(
+        n_groups, group_width, out_dim // n_groups, *n_modes, 2))
+    for weight in param:
+        nn.init.xavier_normal_(weight, gain=gain)
+    return param
+
+
+class FactorizedSpectralWeight(nn.Module):
+    """Spectral weights of shape [in_dim, out_dim, *n_modes] in factored form.
+
+    With 'cp', the weights are a sum of rank-one tensors. With 'tucker', they
+    are a small core tensor multiplied by a factor matrix along each dimension.
+    In both cases, the spectrum is contracted with the factors directly, so the
+    dense weights are never built.
+    """
+
+    def __init__(self, in_dim, out_dim, n_modes, factorization='cp', rank=16,
+                 gain=1):
+        super().__init__()
+        if factorization not in ['cp', 'tucker']:
+            raise ValueError(f'Unknown factorization: {factorization}')
+        self.factorization = factorization
+        self.rank = rank
+
+        # Can't use complex type yet. See https://github.com/pytorch/pytorch/issues/59998
+        if factorization == 'cp':
+            self.in_factor = nn.Parameter(torch.FloatTensor(in_dim, rank, 2))
+            self.out_factor = nn.Parameter(torch.FloatTensor(out_dim, rank, 2))
+            self.mode_factors = nn.ParameterList([
+                nn.Parameter(torch.FloatTensor(m, rank, 2)) for m in n_modes])
+        else:
+            ranks = [min(rank, s) for s in [in_dim, out_dim, *n_modes]]
+            self.in_factor = nn.Parameter(
+                torch.FloatTensor(in_dim, ranks[0], 2))
+            self.out_factor = nn.Parameter(
+                torch.FloatTensor(out_dim, ranks[1], 2))
+            self.mode_factors = nn.ParameterList([
+                nn.Parameter(torch.FloatTensor(m, r, 2))
+                for m, r in zip(n_modes, ranks[2:])])
+            self.core = nn.Parameter(torch.FloatTensor(*ranks, 2))
+
+        self.reset_parameters(in_dim, out_dim, n_modes, gain)
+
+    def reset_parameters(self, in_dim, out_dim, n_modes, gain):
+        # Match the variance of the dense weights under xavier_normal_.
+        receptive = math.prod(n_modes) * 2
+        var = 2 * gain**2 / (in_dim * receptive + out_dim * receptive)
+        factors = [self.in_factor, self.out_factor, *self.mode_factors]
+
+        if self.factorization == 'cp':
+            # Each weight is a sum of rank products of len(factors) terms.
+            std = (var / self.rank) ** (1 / (2 * len(factors)))
+            for factor in factors:
+                nn.init.normal_(factor, std=std)
+        else:
+            # Each weight sums over all elements of the core.
+            for factor in factors:
+                nn.init.normal_(factor, std=1)
+            n_core = self.core[..., 0].numel()
+            nn.init.normal_(self.core, std=math.sqrt(var / n_core))
+
+    def forward(self, x, dims, backend='einsum'):
+        # x.shape == [batch_size, in_dim, *dim_sizes]
+        letters = string.ascii_lowercase[-(x.ndim - 2):]
+
+        in_factor = torch.view_as_complex(self.in_factor)
+        x = torch.einsum(f'bi{letters},ir->br{letters}', x, in_factor)
+        # x.shape == [batch_size, rank, *dim_sizes]
+
+        # Only the modes that x still has after pruning are used.
+        mode_factors = [factor[:x.shape[d]]
+                        for d, factor in zip(dims, self.mode_factors)]
+
+        if self.factorization == 'cp':
+            for d, factor in zip(dims, mode_factors):
+                factor = torch.view_as_complex(factor)
+                shape = [1] * x.ndim
+                shape[1], shape[d] = factor.shape[1], factor.shape[0]
+                x = x * factor.t().reshape(shape)
+        else:
+            # Expanding the core along the modes is cheap since it stays small
+            # in the channel dimensions.
+            core = torch.view_as_complex(self.core)
+            for factor in mode_factors:
+                factor = torch.view_as_complex(factor)
+                core = torch.tensordot(core, factor, dims=([2], [1]))
+            # core.shape == [in_rank, out_rank, *n_modes]
+            x = contract_modes(x, core, dims, backend)
+
+        out_factor = torch.view_as_complex(self.out_factor)
+        x = torch.einsum(f'br{letters},or->bo{letters}', x, out_factor)
+        # x.shape == [batch_size, out_dim, *dim_sizes]
+
+        return x
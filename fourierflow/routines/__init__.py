@@ -1,2 +1,3 @@
 from .grid_2d_markov import Grid2DMarkovExperiment
 from .grid_2d_rollout import Grid2DRolloutExperiment
+from .grid_3d_markov import Grid3DMarkovExperiment
@@ -1,4 +1,6 @@
 import math
+from contextlib import contextmanager
+from functools import partial
 from typing import Optional
 
 import numpy as np
@@ -6,8 +8,13 @@ import torch
 import torch.nn as nn
 from einops import rearrange, repeat
 
-from fourierflow.modules import Normalizer, fourier_encode
+from fourierflow.modules import (FNOFactorized2DBlock, Normalizer,
+                                 fourier_encode)
+from fourierflow.modules.linear import (fold_input_affine, fold_output_affine,
+                                        fold_weight_norm, to_plain_linear)
 from fourierflow.modules.loss import LpLoss
+from fourierflow.modules.spectral import resample_grid
+from fourierflow.utils import compile_fn
 from fourierflow.viz import log_navier_stokes_heatmap
 
 from .base import Routine
@@ -34,6 +41,11 @@ class Grid2DMarkovExperiment(Routine):
                  shuffle_grid: bool = False,
                  use_velocity: bool = False,
                  learn_difference: bool = False,
+                 precision_policy: str = 'fp32',
+                 compile_rollout: bool = False,
+                 latent_rollout: bool = False,
+                 coarse_grid_size: Optional[int] = None,
+                 n_frames: int = 1,
                  **kwargs):
         super().__init__(**kwargs)
         self.conv = conv
@@ -58,6 +70,40 @@ class Grid2DMarkovExperiment(Routine):
         self.shuffle_grid = shuffle_grid
         self.use_velocity = use_velocity
         self.learn_difference = learn_difference
+        # Each forward pass of the conv predicts this many future frames, and
+        # each training target from the builder holds as many.
+        conv_frames = getattr(conv, 'n_frames', 1)
+        if conv_frames != n_frames:
+            raise ValueError(f'The conv predicts {conv_frames} frames per '
+                             f'pass but the targets have {n_frames}')
+        self.n_frames = n_frames
+        # With the 'bf16' policy, the feedforward layers and the residual
+        # stream run in bfloat16 while the spectral parts stay in float32.
+        if precision_policy not in ['fp32', 'bf16']:
+            raise ValueError(f'Unknown precision policy: {precision_policy}')
+        self.precision_policy = precision_policy
+        # The rollout step is compiled lazily on its first call.
+        self.compile_rollout = compile_rollout
+        self._rollout_fn = None
+        # With latent_rollout, validation rollouts stay in the space of the
+        # projected inputs. The other input features are normalized and
+        # projected once, and only the projected frame is added at each step.
+        if latent_rollout and (use_velocity or shuffle_grid or
+                               learn_difference):
+            raise ValueError('Latent rollouts need the decoded frame to be '
+                             'fed back unchanged')
+        if latent_rollout and compile_rollout:
+            raise ValueError('Latent rollouts cannot be compiled')
+        self.latent_rollout = latent_rollout
+        # Outside of training, the conv can run on a coarser grid as long as
+        # it still holds all of its Fourier modes. Only the forecast is
+        # resampled back to the full grid.
+        if coarse_grid_size and shuffle_grid:
+            raise ValueError('Shuffled grids cannot be coarsened')
+        if coarse_grid_size and not isinstance(conv, FNOFactorized2DBlock):
+            raise ValueError('Only FNOFactorized2DBlock can resample its '
+                             'forecast back from a coarse grid')
+        self.coarse_grid_size = coarse_grid_size
         if self.shuffle_grid:
             self.x_idx = torch.randperm(64)
             self.x_inv = torch.argsort(self.x_idx)
@@ -83,6 +129,99 @@ class Grid2DMarkovExperiment(Routine):
         batch = {'data': data}
         return self._valid_step(batch)
 
+    def freeze_for_inference(self):
+        """Fold weight norm and the normalizer into plain linear layers.
+
+        The outputs stay the same, but each rollout step no longer has to
+        recompute the weight-normed weights or normalize its inputs. The frozen
+        routine can't be trained any further.
+        """
+        self.eval()
+        fold_weight_norm(self.conv)
+
+        if self.should_normalize:
+            mean, std = self.normalizer.mean, self.normalizer.std
+            fold_input_affine(self.conv.in_proj, mean, std)
+
+            # The head may be applied to several forks whose outputs are then
+            # summed and optionally averaged, so the shift is rescaled to make
+            # the final forecast come out right.
+            head = getattr(self.conv, 'out', None) or self.conv.feedforward
+            n_summed = self.conv.n_layers if getattr(
+                self.conv, 'use_fork', False) else 1
+            n_divided = self.conv.n_layers if getattr(
+                self.conv, 'avg_outs', False) else 1
+            shift = mean[0:1] * n_divided / n_summed
+            fold_output_affine(head[-1], shift, std[0:1])
+            self.should_normalize = False
+
+        # Folding weight norm creates new parameters, which would otherwise
+        # still require grad.
+        self.requires_grad_(False)
+        # A compiled rollout would still call into the unfrozen weights.
+        self._rollout_fn = None
+        return self
+
+    def quantize_for_inference(self):
+        """Freeze the routine and run its linear layers in int8 on the CPU.
+
+        The weights of the pointwise linear layers, which dominate the FLOPs,
+        are quantized ahead of time and their activations on the fly. The
+        spectral contractions stay in full precision, and so do layers that
+        run as convolutions under channels_first.
+        """
+        self.freeze_for_inference()
+        self.cpu()
+        self.precision_policy = 'fp32'
+        self._rollout_fn = None
+        # The spectral stream projects the input spectra with the weights of
+        # in_proj, which a quantized layer doesn't expose as tensors. Running
+        # in_proj in the grid instead gives the same result.
+        if getattr(self.conv, 'spectral_stream', False):
+            self.conv.spectral_stream = False
+        self.conv = torch.quantization.quantize_dynamic(
+            to_plain_linear(self.conv), {nn.Linear}, dtype=torch.qint8)
+        return self
+
+    @torch.no_grad()
+    def prune_spectral_modes(self, batches, tolerance=1e-3):
+        """Drop the higher Fourier modes that carry little energy.
+
+        The validation rollout is run on the calibration batches while each
+        spectral layer records the energy of its mixed spectrum in each mode.
+        Each layer then keeps, along each axis, the fewest modes whose energy
+        is within the given fraction of its total. The mode counts are saved
+        with the state dict, and weights that aren't shared between layers
+        are sliced down to them. Returns the [y, x] mode counts of each layer.
+        """
+        layers = [layer for layer in getattr(self.conv, 'spectral_layers', [])
+                  if hasattr(layer, 'mode_energy')]
+        for layer in layers:
+            layer.mode_energy = [0, 0]
+        try:
+            for batch in batches:
+                self._valid_step(batch)
+            energies = [layer.mode_energy for layer in layers]
+        finally:
+            for layer in layers:
+                layer.mode_energy = None
+
+        for layer, energy in zip(layers, energies):
+            n_modes = []
+            for e in energy:
+                cum_energy = e.cumsum(0)
+                n_short = (cum_energy < (1 - tolerance) * cum_energy[-1]).sum()
+                n_modes.append(min(int(n_short) + 1, len(e)))
+            layer.prune_modes(n_modes)
+
+        # A compiled rollout would still have the old mode counts baked in.
+        self._rollout_fn = None
+        return [list(layer.n_active_modes) for layer in layers]
+
+    def _autocast(self, device):
+        return torch.autocast(device.type, dtype=torch.bfloat16,
+                              enabled=self.precision_policy == 'bf16')
+
     def encode_positions(self, dim_sizes, low=-1, high=1, fourier=True):
         # dim_sizes is a list of dimensions in all positional/time dimensions
         # e.g. for a 64 x 64 image over 20 steps, dim_sizes = [64, 64, 20]
@@ -171,14 +310,16 @@ class Grid2DMarkovExperiment(Routine):
         if self.shuffle_grid:
             x = x[:, self.x_idx][:, :, self.y_idx]
 
-        im = self.conv(x, global_step=self.global_step)['forecast']
+        with self._autocast(x.device):
+            im = self.conv(x, global_step=self.global_step)['forecast']
+        im = im.float()
 
         if self.shuffle_grid:
             im = im[:, :, self.y_inv][:, self.x_inv]
         if self.should_normalize:
             im = self.normalizer.inverse(im, channel=0)
 
-        # im.shape == [batch_size * time, *dim_sizes, 1]
+        # im.shape == [batch_size * time, *dim_sizes, n_frames]
 
         BN = im.shape[0]
         targets = batch['dy'] if self.learn_difference else batch['y']
@@ -186,7 +327,7 @@ class Grid2DMarkovExperiment(Routine):
 
         return loss
 
-    def _valid_step(self, batch):
+    def _valid_step(self, batch, capture_step=None):
         data = batch['data']
         inputs = data
 
@@ -255,12 +396,26 @@ class Grid2DMarkovExperiment(Routine):
         yy = data[:, ..., -self.n_steps:]
         # yy.shape == [batch_size, *dim_sizes, n_steps]
 
+        if self.latent_rollout:
+            force_channel = None
+            if self.append_force and len(batch['f'].shape) == 4:
+                force_channel = xx.shape[-1] - 1 - int(self.append_mu)
+            frame, cond, proj, forces, force_proj = \
+                self._encode_conditioning(xx, force_channel)
+
         loss = 0
         step_losses = []
-        # We predict one future one step at a time
-        pred_layer_list = []
-        for t in range(self.n_steps):
-            if t == 0:
+        # We predict n_frames future steps at a time
+        layer_forecasts = []
+        for t in range(0, self.n_steps, self.n_frames):
+            if self.latent_rollout:
+                # in_proj is affine, so projecting the normalized frame and
+                # adding it to the projected features is the same as
+                # projecting all inputs together.
+                x = cond + proj * frame
+                if forces is not None:
+                    x = x + force_proj * forces[..., t, :]
+            elif t == 0:
                 x = xx[..., t, :]
                 prev_im = x[..., 0:1]
             else:
@@ -296,34 +451,44 @@ class Grid2DMarkovExperiment(Routine):
                     im = torch.cat([im, mu[..., t, :]], dim=-1)
                 x = im
             # x.shape == [batch_size, *dim_sizes, 3]
+            # or [batch_size, *dim_sizes, width] in a latent rollout
 
-            if self.should_normalize:
-                x = self.normalizer(x)
-            if self.shuffle_grid:
-                x = x[:, self.x_idx][:, :, self.y_idx]
-
-            out = self.conv(x)
-            im = out['forecast']
-
-            if self.shuffle_grid:
-                im = im[:, :, self.y_inv][:, self.x_inv]
-            if self.should_normalize:
-                im = self.normalizer.inverse(im, channel=0)
-            # im.shape == [batch_size, *dim_sizes, 1]
+            if self.latent_rollout:
+                step_fn = eager_fn = partial(self._latent_step,
+                                             output_size=(X, Y))
+            else:
+                step_fn, eager_fn = self.rollout_step, self._rollout_step
 
-            if self.learn_difference:
-                y = yy[..., t] - yy[..., t-1]
+            if capture_step is not None and \
+                    t <= capture_step < t + self.n_frames:
+                # Hooks can't be added to an already compiled step.
+                with self.capture_layer_forecasts() as layer_forecasts:
+                    ims, out = eager_fn(x)
             else:
-                y = yy[..., t]
-            l = self.l2_loss(im.reshape(B, -1), y.reshape(B, -1))
-            step_losses.append(l)
-            loss += l
-            if self.learn_difference:
-                im = prev_im + im
-                prev_im = im
-            preds = im if t == 0 else torch.cat((preds, im), dim=-1)
-            if 'forecast_list' in out:
-                pred_layer_list.append(out['forecast_list'])
+                ims, out = step_fn(x)
+            # ims.shape == [batch_size, *dim_sizes, n_frames]
+
+            if self.latent_rollout:
+                # The normalized forecast, which may be on the coarse grid.
+                frame = out['forecast'][..., -1:].float()
+
+            # Frames past the end of the rollout are dropped. The last frame
+            # that is kept becomes the input of the next forward pass.
+            for step in range(t, min(t + self.n_frames, self.n_steps)):
+                im = ims[..., step - t:step - t + 1]
+                # im.shape == [batch_size, *dim_sizes, 1]
+
+                if self.learn_difference:
+                    y = yy[..., step] - yy[..., step-1]
+                else:
+                    y = yy[..., step]
+                l = self.l2_loss(im.reshape(B, -1), y.reshape(B, -1))
+                step_losses.append(l)
+                loss += l
+                if self.learn_difference:
+                    im = prev_im + im
+                    prev_im = im
+                preds = im if step == 0 else torch.cat((preds, im), dim=-1)
 
         # preds.shape == [batch_size, *dim_sizes, n_steps]
         # yy.shape == [batch_size, *dim_sizes, n_steps]
@@ -343,7 +508,158 @@ class Grid2DMarkovExperiment(Routine):
         loss_full = self.l2_loss(preds.reshape(
             B, -1), yy.reshape(B, -1))
 
-        return loss, loss_full, preds, pred_layer_list, step_losses, diverged_t
+        return loss, loss_full, preds, layer_forecasts, step_losses, diverged_t
+
+    @contextmanager
+    def capture_layer_forecasts(self, sample=0):
+        """Record the forecast of each spectral layer for one sample.
+
+        Forward hooks keep the fork features of the given sample while the
+        block runs. These are decoded with the output head on exit, so the
+        yielded list holds one [1, *dim_sizes, 1] tensor per layer. Blocks
+        without a forecast fork yield an empty list.
+        """
+        forks, forecasts = [], []
+
+        def hook(module, inputs, outputs):
+            if isinstance(outputs, tuple) and outputs[1] is not None:
+                forks.append(outputs[1][sample:sample + 1].detach())
+
+        layers = getattr(self.conv, 'spectral_layers', [])
+        handles = [layer.register_forward_hook(hook) for layer in layers]
+        try:
+            yield forecasts
+        finally:
+            for handle in handles:
+                handle.remove()
+
+        with torch.no_grad():
+            for f in forks:
+                forecast = self.conv.out(f.float())
+                if getattr(self.conv, 'channels_first', False):
+                    forecast = rearrange(forecast, 'b i m n -> b m n i')
+                forecasts.append(forecast)
+
+    @property
+    def rollout_step(self):
+        if not self.compile_rollout:
+            return self._rollout_step
+        if self._rollout_fn is None:
+            self._rollout_fn = compile_fn(self._rollout_step)
+        return self._rollout_fn
+
+    def _coarsen(self, x):
+        # x.shape == [batch_size, *dim_sizes, input_size]
+        M, N = x.shape[1:3]
+        size = self.coarse_grid_size
+        if M % size or N % size:
+            raise ValueError(f'Cannot coarsen a {M}x{N} grid to {size}x{size}'
+                             f' since {size} does not divide both sides')
+        n_modes = getattr(self.conv, 'modes', 0)
+        if size // 2 < n_modes:
+            raise ValueError(f'A grid of size {size} cannot hold the '
+                             f'{n_modes} Fourier modes of the conv')
+        coarse = resample_grid(x, (size, size))
+
+        # Positions aren't periodic and would ring if filtered. They are
+        # subsampled instead.
+        if self.use_position:
+            start = 3 if self.use_velocity else 1
+            n_pos = 2 * (2 * self.num_freq_bands + 1) \
+                if self.use_fourier_position else 2
+            pos = x[:, ::M // size, ::N // size, start:start + n_pos]
+            coarse = torch.cat([coarse[..., :start], pos,
+                                coarse[..., start + n_pos:]], dim=-1)
+
+        return coarse
+
+    def _rollout_step(self, x, **kwargs):
+        # x.shape == [batch_size, *dim_sizes, input_size]
+        if self.coarse_grid_size and not self.training:
+            kwargs['output_size'] = x.shape[1:3]
+            x = self._coarsen(x)
+        if self.should_normalize:
+            x = self.normalizer(x)
+        if self.shuffle_grid:
+            x = x[:, self.x_idx][:, :, self.y_idx]
+
+        with self._autocast(x.device):
+            out = self.conv(x, **kwargs)
+        im = out['forecast'].float()
+
+        if self.shuffle_grid:
+            im = im[:, :, self.y_inv][:, self.x_inv]
+        if self.should_normalize:
+            im = self.normalizer.inverse(im, channel=0)
+
+        return im, out
+
+    def _project_inputs(self, x):
+        # x.shape == [..., input_size]
+        # in_proj is called as a module so that this also works once it has
+        # been quantized.
+        in_proj = self.conv.in_proj
+        if not getattr(self.conv, 'channels_first', False):
+            return in_proj(x)
+        return torch.movedim(in_proj(torch.movedim(x, -1, 1)), 1, -1)
+
+    def _encode_conditioning(self, xx, force_channel=None):
+        # xx.shape == [batch_size, *dim_sizes, n_steps, input_size]
+        # force_channel is the input channel of a time-varying force, if any.
+        # Everything else apart from the frame is the same at every step.
+        B, T = xx.shape[0], xx.shape[-2]
+        if force_channel is None:
+            xx = xx[..., :1, :]
+        x = rearrange(xx, 'b m n t i -> (b t) m n i')
+        if self.coarse_grid_size and not self.training:
+            x = self._coarsen(x)
+        if self.should_normalize:
+            x = self.normalizer(x)
+        x = rearrange(x, '(b t) m n i -> b m n t i', b=B)
+
+        # Only the first frame is taken from the data.
+        frame = x[..., 0, :1]
+        # frame.shape == [batch_size, *dim_sizes, 1]
+
+        # The channels that change from step to step are left out of the
+        # features that are projected once. Each is added back at every step
+        # as a multiple of its column of in_proj.
+        varying = [0] if force_channel is None else [0, force_channel]
+        forces = None
+        if force_channel is not None:
+            forces = x[..., force_channel:force_channel + 1]
+            # forces.shape == [batch_size, *dim_sizes, n_steps, 1]
+
+        static = x[..., 0, :].clone()
+        static[..., varying] = 0
+        cond = self._project_inputs(static)
+        # cond.shape == [batch_size, *dim_sizes, width]
+
+        units = x.new_zeros(len(varying) + 1, 1, x.shape[-1])
+        for k, channel in enumerate(varying):
+            units[k, 0, channel] = 1
+        unit_proj = self._project_inputs(units)[:, 0]
+        projs = unit_proj[:-1] - unit_proj[-1]
+        # projs.shape == [n_varying, width]
+
+        proj = projs[0]
+        force_proj = projs[1] if force_channel is not None else None
+        return frame, cond, proj, forces, force_proj
+
+    def _latent_step(self, h, output_size=None):
+        # h.shape == [batch_size, *dim_sizes, width]
+        with self._autocast(h.device):
+            out = self.conv(h, is_latent=True)
+        im = out['forecast'].float()
+
+        # On a coarse grid, the conv's own forecast is kept to be fed back,
+        # and only the returned frames are resampled.
+        if output_size is not None:
+            im = resample_grid(im, output_size)
+        if self.should_normalize:
+            im = self.normalizer.inverse(im, channel=0)
+
+        return im, out
 
     def training_step(self, batch, batch_idx):
         # Accumulate normalization stats in the first epoch
@@ -376,8 +692,10 @@ class Grid2DMarkovExperiment(Routine):
             return loss
 
     def validation_step(self, batch, batch_idx):
-        loss, loss_full, preds, pred_list, _, diverged_t = self._valid_step(
-            batch)
+        # Layer forecasts are only plotted for the last step of the first batch.
+        capture_step = self.n_steps - 1 if batch_idx == 0 else None
+        loss, loss_full, preds, layers, _, diverged_t = self._valid_step(
+            batch, capture_step)
         self.log('valid_loss_avg', loss)
         self.log('valid_loss', loss_full, prog_bar=True)
         self.log('valid_diverge_t', float(diverged_t), prog_bar=True)
@@ -389,11 +707,12 @@ class Grid2DMarkovExperiment(Routine):
             log_navier_stokes_heatmap(expt, data[0, :, :, 19], 'gt t=19')
             log_navier_stokes_heatmap(expt, preds[0, :, :, -1], 'pred t=19')
 
-            if pred_list:
-                layers = pred_list[-1]
-                for i, layer in enumerate(layers):
-                    log_navier_stokes_heatmap(
-                        expt, layer[0], f'layer {i} t=19')
+            # The captured pass may predict several frames, of which the
+            # last step is this one.
+            frame = capture_step % self.n_frames
+            for i, layer in enumerate(layers):
+                log_navier_stokes_heatmap(
+                    expt, layer[0, ..., frame], f'layer {i} t=19')
 
     def test_step(self, batch, batch_idx):
         loss, loss_full, _, _, step_losses, diverged_t = self._valid_step(
@@ -0,0 +1,194 @@
+from typing import Optional
+
+import torch
+import torch.nn as nn
+from einops import rearrange, repeat
+
+from fourierflow.modules import Normalizer, fourier_encode
+from fourierflow.modules.loss import LpLoss
+from fourierflow.viz import log_navier_stokes_heatmap
+
+from .base import Routine
+
+
+class Grid3DMarkovExperiment(Routine):
+    """Markov rollouts on volumetric grids, such as FNOFactorized3DBlock's.
+
+    The three grid axes can be spatial, or two spatial axes and a time axis
+    for space-time grids. Training batches contain 'x' and 'y' of shape
+    [batch_size, *dim_sizes, 1], and validation batches contain 'data' of
+    shape [batch_size, *dim_sizes, total_steps].
+    """
+
+    def __init__(self,
+                 conv: nn.Module,
+                 n_steps: int,
+                 k_max: int = 32,
+                 num_freq_bands: int = 8,
+                 freq_base: int = 2,
+                 low: float = 0,
+                 high: float = 1,
+                 use_position: bool = True,
+                 max_accumulations: float = 1e6,
+                 should_normalize: bool = True,
+                 use_fourier_position: bool = False,
+                 clip_val: Optional[float] = 0.1,
+                 automatic_optimization: bool = False,
+                 noise_std: float = 0.0,
+                 **kwargs):
+        super().__init__(**kwargs)
+        self.conv = conv
+        self.n_steps = n_steps
+        self.l2_loss = LpLoss(size_average=True)
+        self.use_fourier_position = use_fourier_position
+        self.use_position = use_position
+        self.k_max = k_max
+        self.num_freq_bands = num_freq_bands
+        self.freq_base = freq_base
+        self.low = low
+        self.high = high
+        self.lr = None
+        self.should_normalize = should_normalize
+        self.normalizer = Normalizer([conv.input_dim], max_accumulations)
+        self.register_buffer('_float', torch.FloatTensor([0.1]))
+        self.automatic_optimization = automatic_optimization
+        self.clip_val = clip_val
+        self.noise_std = noise_std
+
+    def forward(self, data):
+        batch = {'data': data}
+        return self._valid_step(batch)
+
+    def encode_positions(self, dim_sizes, low=-1, high=1, fourier=True):
+        # dim_sizes is a list of dimensions in all positional dimensions
+        # e.g. for a 32 x 32 x 32 volume, dim_sizes = [32, 32, 32]
+        def generate_grid(size):
+            return torch.linspace(low, high, steps=size,
+                                  device=self._float.device)
+        grid_list = list(map(generate_grid, dim_sizes))
+        pos = torch.stack(torch.meshgrid(*grid_list, indexing='ij'), dim=-1)
+        # pos.shape == [*dim_sizes, n_dims]
+
+        if not fourier:
+            return pos
+
+        fourier_feats = fourier_encode(
+            pos, self.k_max, self.num_freq_bands, base=self.freq_base)
+        # fourier_feats.shape == [*dim_sizes, n_dims, n_bands * 2 + 1]
+
+        fourier_feats = rearrange(fourier_feats, '... n d -> ... (n d)')
+        # fourier_feats.shape == [*dim_sizes, pos_size]
+
+        return fourier_feats
+
+    def _add_positions(self, x):
+        B, *dim_sizes, _ = x.shape
+        if self.use_position:
+            pos_feats = self.encode_positions(
+                dim_sizes, self.low, self.high, self.use_fourier_position)
+            pos_feats = repeat(pos_feats, '... -> b ...', b=B)
+            # pos_feats.shape == [batch_size, *dim_sizes, pos_size]
+
+            x = torch.cat([x, pos_feats], dim=-1)
+        return x
+
+    def _training_step(self, batch):
+        x = self._add_positions(batch['x'])
+        # x.shape == [batch_size, *dim_sizes, input_size]
+
+        if self.should_normalize:
+            x = self.normalizer(x)
+        x += torch.randn(*x.shape, device=x.device) * self.noise_std
+
+        im = self.conv(x)['forecast']
+        if self.should_normalize:
+            im = self.normalizer.inverse(im, channel=0)
+        # im.shape == [batch_size, *dim_sizes, 1]
+
+        B = im.shape[0]
+        loss = self.l2_loss(im.reshape(B, -1), batch['y'].reshape(B, -1))
+
+        return loss
+
+    def _valid_step(self, batch):
+        data = batch['data']
+        B = data.shape[0]
+        # data.shape == [batch_size, *dim_sizes, total_steps]
+
+        yy = data[..., 1:self.n_steps + 1]
+        # yy.shape == [batch_size, *dim_sizes, n_steps]
+
+        im = data[..., :1]
+        loss = 0
+        step_losses = []
+        # We predict one future one step at a time
+        for t in range(self.n_steps):
+            x = self._add_positions(im)
+            # x.shape == [batch_size, *dim_sizes, input_size]
+
+            if self.should_normalize:
+                x = self.normalizer(x)
+            im = self.conv(x)['forecast']
+            if self.should_normalize:
+                im = self.normalizer.inverse(im, channel=0)
+            # im.shape == [batch_size, *dim_sizes, 1]
+
+            l = self.l2_loss(im.reshape(B, -1), yy[..., t].reshape(B, -1))
+            step_losses.append(l)
+            loss += l
+            preds = im if t == 0 else torch.cat((preds, im), dim=-1)
+
+        # preds.shape == [batch_size, *dim_sizes, n_steps]
+
+        loss /= self.n_steps
+        loss_full = self.l2_loss(preds.reshape(B, -1), yy.reshape(B, -1))
+
+        return loss, loss_full, preds, step_losses
+
+    def training_step(self, batch, batch_idx):
+        # Accumulate normalization stats in the first epoch
+        if self.should_normalize and self.current_epoch == 0:
+            with torch.no_grad():
+                x = self._add_positions(batch['x'])
+                self.normalizer(x)
+
+        if not self.should_normalize or self.current_epoch >= 1:
+            loss = self._training_step(batch)
+            self.log('train_loss', loss, prog_bar=True)
+
+            if not self.automatic_optimization:
+                opt = self.optimizers()
+                opt.zero_grad()
+                self.manual_backward(loss)
+                if self.clip_val:
+                    for group in opt.param_groups:
+                        torch.nn.utils.clip_grad_value_(group["params"],
+                                                        self.clip_val)
+                opt.step()
+
+                sch = self.lr_schedulers()
+                sch.step()
+
+            return loss
+
+    def validation_step(self, batch, batch_idx):
+        loss, loss_full, preds, _ = self._valid_step(batch)
+        self.log('valid_loss_avg', loss)
+        self.log('valid_loss', loss_full, prog_bar=True)
+
+        if batch_idx == 0:
+            # Plot the middle slice along the last grid axis.
+            data = batch['data']
+            mid = data.shape[3] // 2
+            expt = self.logger.experiment
+            log_navier_stokes_heatmap(
+                expt, data[0, :, :, mid, self.n_steps], 'gt last step')
+            log_navier_stokes_heatmap(
+                expt, preds[0, :, :, mid, -1], 'pred last step')
+
+    def test_step(self, batch, batch_idx):
+        loss, loss_full, _, step_losses = self._valid_step(batch)
+        self.log('test_loss_avg', loss)
+        self.log('test_loss', loss_full)
+        for i in range(len(step_losses)):
+            self.log(f'test_loss_{i}', step_losses[i])
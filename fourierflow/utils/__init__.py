@@ -1,3 +1,4 @@
+from .compile import compile_fn
 from .exceptions import ExistingExperimentFound
 from .helpers import cache_fn, default, exists
 from .logger import setup_logger
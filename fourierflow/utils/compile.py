@@ -0,0 +1,31 @@
+import logging
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+def compile_fn(fn):
+    """Compile fn with torch.compile, falling back to eager mode.
+
+    Older versions of Pytorch don't have torch.compile, and some graphs can't
+    be compiled yet. In both cases, we log a warning and keep running fn as is.
+    """
+    if not hasattr(torch, 'compile'):
+        logger.warning('torch.compile is not available. Using eager mode.')
+        return fn
+
+    compiled = torch.compile(fn)
+    use_eager = False
+
+    def run(*args, **kwargs):
+        nonlocal use_eager
+        if not use_eager:
+            try:
+                return compiled(*args, **kwargs)
+            except Exception as e:  # pylint: disable=broad-except
+                logger.warning(f'Compilation failed, using eager mode: {e}')
+                use_eager = True
+        return fn(*args, **kwargs)
+
+    return run
@@ -29,7 +29,7 @@ class MidpointNormalize(mpl.colors.Normalize):
 def log_navier_stokes_heatmap(expt, tensor, name):
     fig = plt.figure(figsize=(6, 6))
     ax = fig.add_subplot(1, 1, 1)
-    vals = tensor.cpu().numpy()
+    vals = tensor.float().cpu().numpy()
     vmax = vals.max()
     vmin = -1 if 'layer' in name else -3
     vmax = 1 if 'layer' in name else 3